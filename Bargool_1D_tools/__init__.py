@@ -1,6 +1,7 @@
 import bpy
 from . import (selectors, import_utils, prop_matchers, geometry,
-               removers, panels, instances, naming, miscellaneous, utils)
+               removers, panels, instances, naming, miscellaneous, utils,
+               mesh_utils, instances_utils)
 from .settings import BatchOperatorSettings, BatchPanelSettings, TestSettings
 
 __author__ = 'Aleksey Nakoryakov'
@@ -21,9 +22,9 @@ bl_info = {
 
 def reload_modules():
     import importlib
-    for m in [selectors, import_utils, prop_matchers,
+    for m in [mesh_utils, selectors, import_utils, prop_matchers,
               removers, panels, settings,
-              instances, naming, miscellaneous,
+              instances_utils, instances, naming, miscellaneous,
               geometry, utils]:
         importlib.reload(m)
 
@@ -36,9 +37,13 @@ def register():
     bpy.types.Scene.batch_panel_settings = bpy.props.PointerProperty(
         type=BatchPanelSettings)
     bpy.types.Scene.test_props = TestSettings
+    mesh_utils.register_handlers()
+    instances.register_handlers()
 
 
 def unregister():
+    mesh_utils.unregister_handlers()
+    instances.unregister_handlers()
     if hasattr(bpy.types.Scene, 'batch_operator_settings'):
         del bpy.types.Scene.batch_operator_settings
     if hasattr(bpy.types.Scene, 'batch_panel_settings'):
@@ -4,11 +4,39 @@ Slope operators
 import bmesh
 import bpy
 
-from .geometry_utils import create_slope_plane, Point
+from .geometry_utils import create_slope_plane, fit_slope_plane, Point, TinSurface
+from .mesh_utils import (np, get_edit_objects, refresh_edit_meshes, sync_edit_meshes,
+                         read_edit_vertex_co, read_edit_vertex_flags, write_edit_vertex_co,
+                         read_vertex_co, write_vertex_co, to_world, to_local,
+                         read_selected_objects, read_object_locations, write_object_locations)
 
 __author__ = 'Aleksey Nakoryakov'
 
 
+def align_to_plane(co, plane, inbound_only):
+    """
+    Vectorized alignment of world coordinates to plane.
+    Returns new zeds and mask of points that could be aligned
+    """
+    z = plane.get_z_many(co[:, 0], co[:, 1])
+    if inbound_only:
+        mask = (plane.selected_z_lower <= z) & (z <= plane.selected_z_upper)
+    else:
+        mask = np.ones(len(co), dtype=np.bool_)
+    return z, mask
+
+
+def align_to_surface(co, surface, inbound_only):
+    """
+    Vectorized alignment of world coordinates to TIN surface.
+    Inbound points are points inside of surface triangles
+    """
+    z, inside = surface.get_z_many(co[:, 0], co[:, 1])
+    if inbound_only:
+        return z, inside
+    return z, np.ones(len(co), dtype=np.bool_)
+
+
 class AlignToSlopeOperator(bpy.types.Operator):
     bl_idname = 'object.align_to_slope'
     bl_label = 'Pick To Slope'
@@ -17,9 +45,15 @@ class AlignToSlopeOperator(bpy.types.Operator):
     class OPERATOR_TYPE_ENUM:
         do_remember = 'DO_REMEMBER'
         do_execute = 'DO_EXECUTE'
+        do_remember_surface = 'DO_REMEMBER_SURFACE'
+        do_execute_surface = 'DO_EXECUTE_SURFACE'
+        do_fit = 'DO_FIT'
 
     operator_type = bpy.props.EnumProperty(items=((OPERATOR_TYPE_ENUM.do_execute,) * 3,
-                                                  (OPERATOR_TYPE_ENUM.do_remember,) * 3),
+                                                  (OPERATOR_TYPE_ENUM.do_remember,) * 3,
+                                                  (OPERATOR_TYPE_ENUM.do_remember_surface,) * 3,
+                                                  (OPERATOR_TYPE_ENUM.do_execute_surface,) * 3,
+                                                  (OPERATOR_TYPE_ENUM.do_fit,) * 3),
                                            options={'HIDDEN'})
 
     @classmethod
@@ -27,45 +61,191 @@ class AlignToSlopeOperator(bpy.types.Operator):
         return context.mode == 'EDIT_MESH'
 
     def execute(self, context):
-        obj = context.active_object
-        bm = bmesh.from_edit_mesh(obj.data)
-        selected_verts = [v for v in bm.verts if v.select]
+        # Slope is in world space, so it works through all objects in edit mode
+        objects = get_edit_objects(context)
 
         if self.operator_type == self.OPERATOR_TYPE_ENUM.do_remember:
+            selected_verts = [(obj.matrix_world, v)
+                              for obj in objects
+                              for v in bmesh.from_edit_mesh(obj.data).verts if v.select]
             if len(selected_verts) != 2:
                 raise AssertionError
             if not selected_verts:
                 self.report({'ERROR'}, 'Must select vertices previously')
                 return {'CANCELLED'}
-            selected_points = [Point(vert.co.x, vert.co.y, vert.co.z) for vert in selected_verts]
+            selected_points = [Point(*(matrix_world * vert.co)) for matrix_world, vert in selected_verts]
             context.scene.test_props.slope_plane = create_slope_plane(*selected_points)
+        elif self.operator_type == self.OPERATOR_TYPE_ENUM.do_fit:
+            if np is None:
+                self.report({'ERROR'}, 'Best fit slope needs numpy')
+                return {'CANCELLED'}
+            slope_plane, rms = fit_slope_plane(self.get_selected_points(objects))
+            if slope_plane is None:
+                self.report({'ERROR'}, 'Must select at least 3 vertices not on one vertical plane')
+                return {'CANCELLED'}
+            context.scene.test_props.slope_plane = slope_plane
+            self.report({'INFO'}, 'Stored best fit slope, RMS residual {:.6f}'.format(rms))
+        elif self.operator_type == self.OPERATOR_TYPE_ENUM.do_remember_surface:
+            if np is None:
+                self.report({'ERROR'}, 'Surface needs numpy')
+                return {'CANCELLED'}
+            surface = TinSurface(self.get_selected_points(objects))
+            if not len(surface):
+                self.report({'ERROR'}, 'Must select at least 3 vertices not on one line')
+                return {'CANCELLED'}
+            context.scene.test_props.surface = surface
+            self.report({'INFO'}, 'Stored surface of {} triangles'.format(len(surface)))
+        elif self.operator_type == self.OPERATOR_TYPE_ENUM.do_execute_surface:
+            surface = context.scene.test_props.surface
+            if not surface:
+                self.report({'ERROR'}, 'Must store surface previously')
+                return {'CANCELLED'}
+            inbound_only = context.scene.batch_operator_settings.geometry_inbound_only
+            skipped_count = self.align_arrays(objects, surface, inbound_only, align_to_surface)
+            refresh_edit_meshes(context, objects)
+            if skipped_count:
+                self.report({'INFO'}, 'Skipped {} vertices'.format(skipped_count))
         else:
             slope_plane = context.scene.test_props.slope_plane
             if not slope_plane:
                 self.report({'ERROR'}, 'Must remember vertices previously')
                 return {'CANCELLED'}
             inbound_only = context.scene.batch_operator_settings.geometry_inbound_only
-            skipped_count = 0
-            for v in selected_verts:
-                z = slope_plane.get_z(v.co.x, v.co.y)
-                if inbound_only:
-                    if slope_plane.selected_z_lower <= z <= slope_plane.selected_z_upper:
-                        v.co.z = z
-                    else:
-                        skipped_count += 1
-                else:
-                    v.co.z = z
-            bpy.ops.object.mode_set(mode='OBJECT')
-            bpy.ops.object.mode_set(mode='EDIT')
+            if np is None:
+                skipped_count = self.align_bmesh(objects, slope_plane, inbound_only)
+            else:
+                skipped_count = self.align_arrays(objects, slope_plane, inbound_only, align_to_plane)
+            refresh_edit_meshes(context, objects)
             if skipped_count:
                 self.report({'INFO'}, 'Skipped {} vertices'.format(skipped_count))
         return {'FINISHED'}
 
+    def get_selected_points(self, objects):
+        """ World coordinates of selected vertices of all objects as array """
+        sync_edit_meshes(objects)
+        return np.concatenate([
+            to_world(read_edit_vertex_co(obj)[read_edit_vertex_flags(obj)[1]], obj.matrix_world)
+            for obj in objects])
+
+    def align_arrays(self, objects, target, inbound_only, align_func):
+        """
+        Vectorized alignment of selected vertices to plane or surface with align_func.
+        Returns count of skipped
+        """
+        sync_edit_meshes(objects)
+        skipped_count = 0
+        for obj in objects:
+            _, select = read_edit_vertex_flags(obj)
+            indices = np.flatnonzero(select)
+            co = to_world(read_edit_vertex_co(obj)[indices], obj.matrix_world)
+            z, mask = align_func(co, target, inbound_only)
+            skipped_count += len(indices) - int(np.count_nonzero(mask))
+            co[:, 2] = z
+            write_edit_vertex_co(obj, indices[mask], to_local(co[mask], obj.matrix_world))
+        return skipped_count
+
+    def align_bmesh(self, objects, slope_plane, inbound_only):
+        """ Per-vertex alignment of selected vertices. Returns count of skipped """
+        skipped_count = 0
+        for obj in objects:
+            matrix_world = obj.matrix_world.copy()
+            matrix_local = matrix_world.inverted()
+            for v in bmesh.from_edit_mesh(obj.data).verts:
+                if not v.select:
+                    continue
+                co = matrix_world * v.co
+                z = slope_plane.get_z(co.x, co.y)
+                if inbound_only and not slope_plane.selected_z_lower <= z <= slope_plane.selected_z_upper:
+                    skipped_count += 1
+                    continue
+                co.z = z
+                v.co = matrix_local * co
+        return skipped_count
+
+
+class AlignMeshesToSlopeOperator(bpy.types.Operator):
+    bl_idname = 'object.align_meshes_to_slope'
+    bl_label = 'Align meshes to slope'
+    bl_description = 'Aligns all vertices of selected meshes to stored slope without edit mode'
+    bl_options = {'REGISTER', 'UNDO'}
+
+    @classmethod
+    def poll(cls, context):
+        return np is not None and context.mode == 'OBJECT' and context.selected_objects
+
+    def execute(self, context):
+        slope_plane = context.scene.test_props.slope_plane
+        if not slope_plane:
+            self.report({'ERROR'}, 'Must remember vertices previously')
+            return {'CANCELLED'}
+        inbound_only = context.scene.batch_operator_settings.geometry_inbound_only
+        skipped_count = 0
+        objects = [o for o in context.selected_objects if o.type == 'MESH']
+        # Mesh of instances could not fit slope by transforms of all of them
+        shared = set(o.data.name for o in objects if o.data.users > 1)
+        for obj in objects:
+            if obj.data.name in shared:
+                continue
+            local_co = read_vertex_co(obj.data)
+            co = to_world(local_co, obj.matrix_world)
+            z, mask = align_to_plane(co, slope_plane, inbound_only)
+            skipped_count += len(co) - int(np.count_nonzero(mask))
+            co[:, 2] = z
+            local_co[mask] = to_local(co[mask], obj.matrix_world)
+            write_vertex_co(obj.data, local_co)
+        if shared:
+            self.report({'WARNING'}, 'Skipped {} meshes with several users'.format(len(shared)))
+        if skipped_count:
+            self.report({'INFO'}, 'Skipped {} vertices'.format(skipped_count))
+        return {'FINISHED'}
+
+
+class DropObjectsToSlopeOperator(bpy.types.Operator):
+    bl_idname = 'object.drop_objects_to_slope'
+    bl_label = 'Drop objects to slope'
+    bl_description = 'Moves locations of selected objects to stored slope by Z'
+    bl_options = {'REGISTER', 'UNDO'}
+
+    @classmethod
+    def poll(cls, context):
+        return np is not None and context.mode == 'OBJECT' and context.selected_objects
+
+    def execute(self, context):
+        slope_plane = context.scene.test_props.slope_plane
+        if not slope_plane:
+            self.report({'ERROR'}, 'Must remember vertices previously')
+            return {'CANCELLED'}
+        inbound_only = context.scene.batch_operator_settings.geometry_inbound_only
+        objects = context.scene.objects
+        objects_list, indices = read_selected_objects(context.scene)
+        location = read_object_locations(objects)
+        z, mask = align_to_plane(location[indices], slope_plane, inbound_only)
+        # Location of child is in space of parent, so it is skipped
+        mask &= np.fromiter((objects_list[i].parent is None for i in indices.tolist()),
+                            dtype=np.bool_, count=len(indices))
+        location[indices[mask], 2] = z[mask]
+        write_object_locations(objects, location)
+        # foreach_set does not tag objects for update
+        for i in indices[mask].tolist():
+            objects_list[i].update_tag(refresh={'OBJECT'})
+        skipped_count = len(indices) - int(np.count_nonzero(mask))
+        if skipped_count:
+            self.report({'INFO'}, 'Skipped {} objects'.format(skipped_count))
+        return {'FINISHED'}
+
 
 def create_panel(col, scene):
     col.operator(AlignToSlopeOperator.bl_idname,
                  text='Store slope').operator_type = AlignToSlopeOperator.OPERATOR_TYPE_ENUM.do_remember
+    col.operator(AlignToSlopeOperator.bl_idname,
+                 text='Store best fit slope').operator_type = AlignToSlopeOperator.OPERATOR_TYPE_ENUM.do_fit
     col.operator(AlignToSlopeOperator.bl_idname,
                  text='Align to slope').operator_type = AlignToSlopeOperator.OPERATOR_TYPE_ENUM.do_execute
+    col.operator(AlignMeshesToSlopeOperator.bl_idname)
+    col.operator(DropObjectsToSlopeOperator.bl_idname)
+    col.operator(AlignToSlopeOperator.bl_idname,
+                 text='Store surface').operator_type = AlignToSlopeOperator.OPERATOR_TYPE_ENUM.do_remember_surface
+    col.operator(AlignToSlopeOperator.bl_idname,
+                 text='Align to surface').operator_type = AlignToSlopeOperator.OPERATOR_TYPE_ENUM.do_execute_surface
     col.prop(scene.batch_operator_settings,
              'geometry_inbound_only')
@@ -1,124 +1,134 @@
 """
-Classes for geometry manipulations
+Classes for geometry manipulations.
+Methods with "many" work with numpy arrays of points, one point per row
 """
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 __author__ = 'Aleksey Nakoryakov'
 
 
 class Point(object):
+    __slots__ = ('x', 'y', 'z')
+
     def __init__(self, x, y, z):
-        self._x = x
-        self._y = y
-        self._z = z
+        self.x = x
+        self.y = y
+        self.z = z
 
-    @property
-    def x(self):
-        return self._x
+    def __iter__(self):
+        return iter((self.x, self.y, self.z))
 
-    @property
-    def y(self):
-        return self._y
 
-    @property
-    def z(self):
-        return self._z
-
-
-class Vector(object):
-    def __init__(self, **kwargs):
-        if 'x' in kwargs and 'y' in kwargs and 'z' in kwargs:
-            self._x = kwargs['x']
-            self._y = kwargs['y']
-            self._z = kwargs['z']
-        elif 'p0' in kwargs and 'p1' in kwargs:
-            p0 = kwargs['p0']
-            p1 = kwargs['p1']
-            self._x = p1.x - p0.x
-            self._y = p1.y - p0.y
-            self._z = p1.z - p0.z
-        else:
-            raise AttributeError
+class Vector(Point):
+    __slots__ = ()
 
-    @property
-    def x(self):
-        return self._x
+    @classmethod
+    def from_points(cls, p0, p1):
+        return cls(p1.x - p0.x, p1.y - p0.y, p1.z - p0.z)
 
-    @property
-    def y(self):
-        return self._y
+    def dot(self, other):
+        return self.x * other.x + self.y * other.y + self.z * other.z
 
-    @property
-    def z(self):
-        return self._z
+    def cross(self, other):
+        return Vector(self.y * other.z - self.z * other.y,
+                      self.z * other.x - self.x * other.z,
+                      self.x * other.y - self.y * other.x)
 
 
 class Line(object):
-    def __init__(self, **kwargs):
-        if 'point' in kwargs and 'vector' in kwargs:
-            point = kwargs['point']
-            vector = kwargs['vector']
-            self._x0 = point.x
-            self._y0 = point.y
-            self._z0 = point.z
-            self._p1 = vector.x
-            self._p2 = vector.y
-            self._p3 = vector.z
-            self._vector = vector
-        else:
-            raise AttributeError
+    __slots__ = ('point', 'vector')
 
-    @property
-    def vector(self):
-        return self._vector
+    def __init__(self, point, vector):
+        self.point = point
+        self.vector = vector
 
     def get_point_on_line(self, x=None, y=None, z=None):
         assert len([i for i in (x, y, z) if i is not None]) == 1
+        p, v = self.point, self.vector
         if x is not None:
-            t = -1 * self._x0 / self._p1
+            t = (x - p.x) / v.x
         elif y is not None:
-            t = -1 * self._y0 / self._p2
+            t = (y - p.y) / v.y
         else:  # z is not None
-            t = -1 * self._z0 / self._p3
+            t = (z - p.z) / v.z
         return Point(
-            x or self._p1 * t + self._x0,
-            y or self._p2 * t + self._y0,
-            z or self._p3 * t + self._z0
+            x if x is not None else v.x * t + p.x,
+            y if y is not None else v.y * t + p.y,
+            z if z is not None else v.z * t + p.z
         )
 
 
 class Plane(object):
-    def __init__(self, **kwargs):
-        if 'point' in kwargs and 'normal' in kwargs:
-            point = kwargs['point']
-            normal = kwargs['normal']
-            self._a = normal.x
-            self._b = normal.y
-            self._c = normal.z
-            self._d = -1 * (normal.x * point.x) - (normal.y * point.y) - (normal.z * point.z)
-        elif 'point' in kwargs and 'vector1' in kwargs and 'vector2' in kwargs:
-            p = kwargs['point']
-            v = kwargs['vector1']
-            w = kwargs['vector2']
-            self._a = v.y*w.z - w.y * v.z
-            self._b = w.x * v.z - v.x * w.z
-            self._c = v.x * w.y - w.x * v.y
-            self._d = (p.x * w.y * v.z + p.y * v.x * w.z + p.z * w.x * v.y -
-                       p.x * v.y * w.z - p.y * w.x * v.z - p.z * v.x * w.y)
-        else:
-            raise AttributeError
-        self.selected_z_lower = kwargs.get('z_lower', None)
-        self.selected_z_upper = kwargs.get('z_upper', None)
+    """ Plane a*x + b*y + c*z + d = 0 """
+    __slots__ = ('a', 'b', 'c', 'd', 'selected_z_lower', 'selected_z_upper')
+
+    def __init__(self, a, b, c, d, z_lower=None, z_upper=None):
+        self.a = a
+        self.b = b
+        self.c = c
+        self.d = d
+        self.selected_z_lower = z_lower
+        self.selected_z_upper = z_upper
+
+    @classmethod
+    def from_normal(cls, point, normal, z_lower=None, z_upper=None):
+        return cls(normal.x, normal.y, normal.z,
+                   -1 * (normal.x * point.x) - (normal.y * point.y) - (normal.z * point.z),
+                   z_lower, z_upper)
+
+    @classmethod
+    def from_vectors(cls, point, vector1, vector2, z_lower=None, z_upper=None):
+        p, v, w = point, vector1, vector2
+        return cls(v.y * w.z - w.y * v.z,
+                   w.x * v.z - v.x * w.z,
+                   v.x * w.y - w.x * v.y,
+                   (p.x * w.y * v.z + p.y * v.x * w.z + p.z * w.x * v.y -
+                    p.x * v.y * w.z - p.y * w.x * v.z - p.z * v.x * w.y),
+                   z_lower, z_upper)
+
+    @property
+    def normal(self):
+        return Vector(self.a, self.b, self.c)
 
     def intersect(self, plane):
         if not isinstance(plane, Plane):
             raise AttributeError
-        x = self._b * plane._c - self._c * plane._b
-        y = self._c * plane._a - self._a * plane._c
-        z = self._a * plane._b - self._b * plane._a
-        return Vector(x=x, y=y, z=z)
+        return self.normal.cross(plane.normal)
 
     def get_z(self, x, y):
-        return (-1 * self._a * x - self._b * y - self._d) / self._c if self._c else 0
+        return (-1 * self.a * x - self.b * y - self.d) / self.c if self.c else 0
+
+    def get_z_many(self, x, y):
+        """ get_z for arrays of x and y """
+        if not self.c:
+            return np.zeros(len(x))
+        return (-1 * self.a * np.asarray(x) - self.b * np.asarray(y) - self.d) / self.c
+
+    def signed_distance_many(self, points):
+        """ Signed distances from points to plane, positive on the side of normal """
+        normal = np.array(tuple(self.normal))
+        return (np.dot(points, normal) + self.d) / np.sqrt(np.dot(normal, normal))
+
+    def project_many(self, points):
+        """ Orthogonal projections of points to plane """
+        normal = np.array(tuple(self.normal))
+        distances = (np.dot(points, normal) + self.d) / np.dot(normal, normal)
+        return points - distances[:, np.newaxis] * normal
+
+    def intersect_lines_many(self, points, vectors):
+        """
+        Intersections of lines point + t * vector with plane.
+        Rows of lines parallel to plane are nan
+        """
+        normal = np.array(tuple(self.normal))
+        denominators = np.dot(vectors, normal)
+        parallel = denominators == 0
+        t = -(np.dot(points, normal) + self.d) / np.where(parallel, 1, denominators)
+        t[parallel] = np.nan
+        return points + t[:, np.newaxis] * vectors
 
 
 def create_slope_plane(point0, point1):
@@ -126,18 +136,381 @@ def create_slope_plane(point0, point1):
 
     # If points on same height - we need just horizontal plane
     if point0.z == point1.z:
-        return Plane(point=point0, normal=Vector(x=0, y=0, z=1), z_lower=point0.z, z_upper=point0.z)
+        return Plane.from_normal(point0, Vector(0, 0, 1), z_lower=point0.z, z_upper=point0.z)
 
     # We are going to create plane that perpendicular to input line point0 - point1
     # Then we intersect it to plane XOY and retrieve line perpendicular to previous
     # With this two lines we create slope plane
-    v = Vector(p0=point0, p1=point1)
-    line1 = Line(point=point0, vector=v)
+    v = Vector.from_points(point0, point1)
+    line1 = Line(point0, v)
     intersect_point = line1.get_point_on_line(z=0)
 
-    plane = Plane(point=intersect_point, normal=v)
-    plane_xoy = Plane(point=intersect_point, normal=Vector(x=0, y=0, z=1))
-    intersect_line = Line(point=intersect_point, vector=plane.intersect(plane_xoy))
-    return Plane(point=intersect_point,
-                 vector1=v, vector2=intersect_line.vector,
-                 z_lower=min(point0.z, point1.z), z_upper=max(point0.z, point1.z))
+    plane = Plane.from_normal(intersect_point, v)
+    plane_xoy = Plane.from_normal(intersect_point, Vector(0, 0, 1))
+    intersect_line = Line(intersect_point, plane.intersect(plane_xoy))
+    return Plane.from_vectors(intersect_point, v, intersect_line.vector,
+                              z_lower=min(point0.z, point1.z), z_upper=max(point0.z, point1.z))
+
+
+def fit_slope_plane(points):
+    """
+    Least squares plane z = a*x + b*y + c through points.
+    Returns plane and root mean square of zed residuals,
+    or None and None if points are on one vertical plane
+    """
+    points = np.asarray(points, dtype=np.float64)
+    # Centered coordinates keep the solve well conditioned far from origin
+    center = points.mean(axis=0)
+    centered = points - center
+    matrix = np.column_stack((centered[:, 0], centered[:, 1], np.ones(len(points))))
+    solution, _, rank, _ = np.linalg.lstsq(matrix, centered[:, 2], rcond=-1)
+    if rank < 3:
+        return None, None
+    a, b, c = solution
+    residuals = centered[:, 2] - np.dot(matrix, solution)
+    rms = float(np.sqrt(np.mean(residuals * residuals)))
+    # a*x + b*y - z + d = 0 with normal looking up
+    d = c + center[2] - a * center[0] - b * center[1]
+    plane = Plane(-a, -b, 1.0, -d,
+                  z_lower=float(points[:, 2].min()), z_upper=float(points[:, 2].max()))
+    return plane, rms
+
+
+def _get_insertion_order(points):
+    """
+    Order of points along snake through rows of grid cells, so consecutive points are close.
+    Points with same XY are used once
+    """
+    order = np.lexsort((points[:, 1], points[:, 0]))
+    first = np.zeros(len(points), dtype=np.bool_)
+    first[order[np.r_[True, np.any(points[order][1:] != points[order][:-1], axis=1)]]] = True
+    rows_count = int(np.sqrt(len(points) / 4.0)) + 1
+    rows = np.minimum(((points[:, 1] + 0.5) * rows_count).astype(np.int64), rows_count - 1)
+    # Odd rows are passed backwards
+    order = np.lexsort((np.where(rows % 2, -points[:, 0], points[:, 0]), rows))
+    return order[first[order]].tolist()
+
+
+def delaunay_triangles(xy):
+    """
+    Bowyer-Watson Delaunay triangulation of 2d points.
+    Hull edges are closed by ghost triangles with vertex at infinity instead of
+    finite super triangle, which could miss thin triangles along the hull.
+    Point is in circumcircle of ghost triangle, if it is out of its hull edge
+    or on the edge between its ends.
+    Triangles keep their neighbours, so triangle containing inserted point is found
+    by walk from the last created triangle, and triangles whose circumcircles contain
+    the point are found by search through neighbours from it.
+    Slots of removed triangles are reused by new ones.
+    Returns array of counterclockwise triangles as indices of points.
+    Points with same XY are used once
+    """
+    xy = np.asarray(xy, dtype=np.float64)
+    count = len(xy)
+    if count < 3:
+        return np.empty((0, 3), dtype=np.int64)
+    # Work in unit square for numerical stability
+    low, high = xy.min(axis=0), xy.max(axis=0)
+    size = (high - low).max() or 1.0
+    points = (xy - (low + high) / 2) / size
+    order = _get_insertion_order(points)
+    # Vertex at infinity has index count, its coordinates are never used
+    ghost = count
+    px, py = points[:, 0].tolist() + [0.0], points[:, 1].tolist() + [0.0]
+
+    def orient(a, b, x, y):
+        """ Positive if point is to the left of a to b """
+        return (px[b] - px[a]) * (y - py[a]) - (py[b] - py[a]) * (x - px[a])
+
+    # The first triangle is made of two first points and the first point off their line
+    a, b = order[0], order[1]
+    third = next((i for i in range(2, len(order)) if orient(a, b, px[order[i]], py[order[i]])), None)
+    if third is None:
+        return np.empty((0, 3), dtype=np.int64)
+    c = order.pop(third)
+    if orient(a, b, px[c], py[c]) < 0:
+        a, b = b, a
+
+    # Flat lists, triangle t has items from 3 * t to 3 * t + 2.
+    # Neighbour i of triangle is across its edge from vertex i to the next one
+    verts = [a, b, c, b, a, ghost, c, b, ghost, a, c, ghost]
+    edges = dict(((verts[3 * t + i], verts[3 * t + (i + 1) % 3]), t) for t in range(4) for i in range(3))
+    neighbours = [edges[verts[3 * t + (i + 1) % 3], verts[3 * t + i]] for t in range(4) for i in range(3)]
+    free = []
+
+    def in_circle(t, x, y):
+        a, b, c = verts[3 * t:3 * t + 3]
+        if ghost in (a, b, c):
+            # Hull edge goes from vertex after ghost to the next one, outside is to the left
+            i = (a, b, c).index(ghost)
+            a, b = verts[3 * t + (i + 1) % 3], verts[3 * t + (i + 2) % 3]
+            side = orient(a, b, x, y)
+            if side:
+                return side > 0
+            return (px[a] - x) * (px[b] - x) + (py[a] - y) * (py[b] - y) < 0
+        adx, ady = px[a] - x, py[a] - y
+        bdx, bdy = px[b] - x, py[b] - y
+        cdx, cdy = px[c] - x, py[c] - y
+        return ((adx * adx + ady * ady) * (bdx * cdy - cdx * bdy) +
+                (bdx * bdx + bdy * bdy) * (cdx * ady - adx * cdy) +
+                (cdx * cdx + cdy * cdy) * (adx * bdy - bdx * ady)) > 0
+
+    def locate(t, x, y):
+        if ghost in verts[3 * t:3 * t + 3]:
+            # Walk starts from real triangle behind hull edge
+            t = neighbours[3 * t + (verts.index(ghost, 3 * t, 3 * t + 3) + 1) % 3]
+        for _ in range(len(verts) // 3):
+            a, b, c = verts[3 * t:3 * t + 3]
+            if orient(a, b, x, y) < 0:
+                t = neighbours[3 * t]
+            elif orient(b, c, x, y) < 0:
+                t = neighbours[3 * t + 1]
+            elif orient(c, a, x, y) < 0:
+                t = neighbours[3 * t + 2]
+            else:
+                return t
+            if ghost in verts[3 * t:3 * t + 3]:
+                # Point is out of hull edge, so it is in circumcircle of ghost triangle
+                return t
+        # Float rounding made walk cycle, any triangle with point in circumcircle will do
+        removed = set(free)
+        return next(t for t in range(len(verts) // 3) if t not in removed and in_circle(t, x, y))
+
+    last = 0
+    for index in order[2:]:
+        x, y = px[index], py[index]
+        cavity = {locate(last, x, y)}
+        stack = list(cavity)
+        # Edges of cavity with triangles out of it
+        boundary = []
+        while stack:
+            t = stack.pop()
+            for i in range(3):
+                n = neighbours[3 * t + i]
+                if n in cavity:
+                    continue
+                if in_circle(n, x, y):
+                    cavity.add(n)
+                    stack.append(n)
+                else:
+                    boundary.append((verts[3 * t + i], verts[3 * t + (i + 1) % 3], n))
+        free.extend(cavity)
+        by_start, by_end = {}, {}
+        for a, b, n in boundary:
+            if free:
+                t = free.pop()
+                verts[3 * t:3 * t + 3] = a, b, index
+                neighbours[3 * t] = n
+            else:
+                t = len(verts) // 3
+                verts.extend((a, b, index))
+                neighbours.extend((n, -1, -1))
+            # Outer triangle has the same edge from b to a
+            neighbours[verts.index(b, 3 * n, 3 * n + 3)] = t
+            by_start[a] = t
+            by_end[b] = t
+        for a, t in by_start.items():
+            neighbours[3 * t + 1] = by_start[verts[3 * t + 1]]
+            neighbours[3 * t + 2] = by_end[a]
+        last = t
+
+    alive = np.ones(len(verts) // 3, dtype=np.bool_)
+    alive[free] = False
+    result = np.array(verts, dtype=np.int64).reshape((-1, 3))[alive]
+    return result[np.all(result < count, axis=1)]
+
+
+class TinSurface(object):
+    """
+    Triangulated irregular network surface through points.
+    Triangles are hashed to grid of cells by their XY bounding boxes,
+    so triangle containing a point is found by binary search of its cell
+    """
+    __slots__ = ('points', 'triangles', 'planes', 'cell_size', 'origin', 'width',
+                 'cell_keys', 'cell_starts', 'cell_counts', 'cell_triangles', 'centroid_cells')
+
+    def __init__(self, points):
+        self.points = np.asarray(points, dtype=np.float64)
+        self.centroid_cells = None
+        triangles = delaunay_triangles(self.points[:, :2])
+        p0, p1, p2 = (self.points[triangles[:, i]] for i in range(3))
+        normals = np.cross(p1 - p0, p2 - p0)
+        # Triangles flat in XY could not give zed
+        triangles = triangles[normals[:, 2] > 0]
+        normals = normals[normals[:, 2] > 0]
+        self.triangles = triangles
+        p0 = self.points[triangles[:, 0]]
+        # z = a*x + b*y + c for each triangle
+        a = -normals[:, 0] / normals[:, 2]
+        b = -normals[:, 1] / normals[:, 2]
+        self.planes = np.column_stack((a, b, p0[:, 2] - a * p0[:, 0] - b * p0[:, 1]))
+        if not len(triangles):
+            return
+
+        xy = self.points[:, :2][triangles]
+        low, high = xy.min(axis=1), xy.max(axis=1)
+        self.origin = low.min(axis=0)
+        extent = high.max(axis=0) - self.origin
+        self.cell_size = np.sqrt(max(extent[0] * extent[1], 1e-12) / len(triangles)) or 1.0
+        low_cells = self.get_cells(low)
+        high_cells = self.get_cells(high)
+        self.width = high_cells[:, 1].max() + 1
+        # Register each triangle in all cells of its bounding box
+        spans = high_cells - low_cells + 1
+        counts = spans[:, 0] * spans[:, 1]
+        triangle_index = np.repeat(np.arange(len(triangles)), counts)
+        steps = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        span_y = spans[triangle_index, 1]
+        cx = low_cells[triangle_index, 0] + steps // span_y
+        cy = low_cells[triangle_index, 1] + steps % span_y
+        keys = cx * self.width + cy
+        order = np.argsort(keys, kind='mergesort')
+        keys = keys[order]
+        self.cell_triangles = triangle_index[order]
+        self.cell_starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+        self.cell_keys = keys[self.cell_starts]
+        self.cell_counts = np.diff(np.r_[self.cell_starts, len(keys)])
+
+    def __len__(self):
+        return len(self.triangles)
+
+    def get_cells(self, xy):
+        return np.floor((xy - self.origin) / self.cell_size).astype(np.int64)
+
+    def find_triangles(self, x, y):
+        """ Indices of triangles containing points. -1 for points outside of surface """
+        result = np.full(len(x), -1, dtype=np.int64)
+        if not len(self.triangles):
+            return result
+        cells = self.get_cells(np.column_stack((x, y)))
+        inside = np.flatnonzero((cells[:, 0] >= 0) & (cells[:, 1] >= 0) &
+                                (cells[:, 1] < self.width))
+        keys = cells[inside, 0] * self.width + cells[inside, 1]
+        positions = np.searchsorted(self.cell_keys, keys)
+        found = positions < len(self.cell_keys)
+        found[found] = self.cell_keys[positions[found]] == keys[found]
+        points, positions = inside[found], positions[found]
+        starts, counts = self.cell_starts[positions], self.cell_counts[positions]
+        for step in range(counts.max() if len(counts) else 0):
+            candidates = np.flatnonzero(counts > step)
+            triangles = self.cell_triangles[starts[candidates] + step]
+            hit = self.contains(triangles, x[points[candidates]], y[points[candidates]])
+            result[points[candidates[hit]]] = triangles[hit]
+            # Found points are not looked up anymore
+            keep = np.ones(len(points), dtype=np.bool_)
+            keep[candidates[hit]] = False
+            points, starts, counts = points[keep], starts[keep], counts[keep]
+        return result
+
+    def contains(self, triangles, x, y, eps=1e-12):
+        """ Whether each triangle contains corresponding point. Edges are inside """
+        xy = self.points[:, :2][self.triangles[triangles]]
+        px, py = x - xy[:, 0, 0], y - xy[:, 0, 1]
+        e1, e2 = xy[:, 1] - xy[:, 0], xy[:, 2] - xy[:, 0]
+        det = e1[:, 0] * e2[:, 1] - e1[:, 1] * e2[:, 0]
+        u = (px * e2[:, 1] - py * e2[:, 0]) / det
+        v = (e1[:, 0] * py - e1[:, 1] * px) / det
+        return (u >= -eps) & (v >= -eps) & (u + v <= 1 + eps)
+
+    def get_centroid_cells(self):
+        """
+        Centroids of triangles hashed to cells of the grid, sorted by cells.
+        Returns centroids, their triangles, keys, starts and counts of cells, count of grid columns
+        """
+        if self.centroid_cells is None:
+            centroids = self.points[:, :2][self.triangles].mean(axis=1)
+            cells = self.get_cells(centroids)
+            keys = cells[:, 0] * self.width + cells[:, 1]
+            order = np.argsort(keys, kind='mergesort')
+            keys = keys[order]
+            starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+            self.centroid_cells = (centroids[order], order, keys[starts], starts,
+                                   np.diff(np.r_[starts, len(keys)]), int(cells[:, 0].max()) + 1)
+        return self.centroid_cells
+
+    @staticmethod
+    def get_ring_offsets(ring):
+        """ Offsets of cells, which are ring cells away from center cell by X or Y """
+        if not ring:
+            return np.zeros((1, 2), dtype=np.int64)
+        side = np.arange(-ring, ring + 1)
+        inner = side[1:-1]
+        return np.concatenate((
+            np.column_stack((side, np.full(len(side), -ring))),
+            np.column_stack((side, np.full(len(side), ring))),
+            np.column_stack((np.full(len(inner), -ring), inner)),
+            np.column_stack((np.full(len(inner), ring), inner))))
+
+    def nearest_triangles(self, x, y, chunk=4096, rings=16, memory=1 << 20):
+        """
+        Indices of triangles with nearest centroids to points.
+        Cells of the grid are searched by square rings around points, until centroids of
+        next rings could not be nearer than found ones. Points far from surface need
+        too many rings, so after given count of rings the rest of them is compared
+        with all centroids by chunks of about memory pairs
+        """
+        centroids, triangles, keys, starts, counts, columns = self.get_centroid_cells()
+        size = np.array((columns, self.width))
+        result = np.empty(len(x), dtype=np.int64)
+        for start in range(0, len(x), chunk):
+            xy = np.column_stack((x[start:start + chunk], y[start:start + chunk]))
+            # Points out of grid start from the nearest cell of its border
+            cells = np.clip(self.get_cells(xy), 0, size - 1)
+            gap = (np.maximum(self.origin - xy, 0) +
+                   np.maximum(xy - (self.origin + size * self.cell_size), 0))
+            gap = (gap * gap).sum(axis=1)
+            best = np.full(len(xy), np.inf)
+            nearest = np.zeros(len(xy), dtype=np.int64)
+            for ring in range(min(size.max(), rings) + 1):
+                # Centroids of the ring are at least ring - 1 cells away from point on border
+                bound = gap + (max(ring - 1, 0) * self.cell_size) ** 2
+                active = np.flatnonzero(best > bound)
+                if not len(active) or ring == rings:
+                    break
+                offsets = self.get_ring_offsets(ring)
+                points = np.repeat(active, len(offsets))
+                ring_cells = cells[points] + np.tile(offsets, (len(active), 1))
+                inside = np.all((ring_cells >= 0) & (ring_cells < size), axis=1)
+                points, ring_cells = points[inside], ring_cells[inside]
+                cell_keys = ring_cells[:, 0] * self.width + ring_cells[:, 1]
+                positions = np.searchsorted(keys, cell_keys)
+                found = positions < len(keys)
+                found[found] = keys[positions[found]] == cell_keys[found]
+                points, positions = points[found], positions[found]
+                # Expand pairs of point and cell to pairs of point and centroid
+                cell_counts = counts[positions]
+                steps = np.arange(cell_counts.sum()) - np.repeat(np.cumsum(cell_counts) - cell_counts,
+                                                                 cell_counts)
+                indices = np.repeat(starts[positions], cell_counts) + steps
+                points = np.repeat(points, cell_counts)
+                distances = ((centroids[indices] - xy[points]) ** 2).sum(axis=1)
+                # The nearest centroid of the ring for each point
+                order = np.lexsort((distances, points))
+                points, indices, distances = points[order], indices[order], distances[order]
+                first = np.r_[True, points[1:] != points[:-1]] if len(points) else []
+                points, indices, distances = points[first], indices[first], distances[first]
+                better = distances < best[points]
+                best[points[better]] = distances[better]
+                nearest[points[better]] = triangles[indices[better]]
+            if ring == rings and len(active):
+                step = max(1, memory // len(centroids))
+                for far in range(0, len(active), step):
+                    points = active[far:far + step]
+                    distances = ((xy[points, np.newaxis, :] - centroids[np.newaxis, :, :]) ** 2).sum(axis=2)
+                    nearest[points] = triangles[distances.argmin(axis=1)]
+            result[start:start + chunk] = nearest
+        return result
+
+    def get_z_many(self, x, y):
+        """
+        Zeds of surface at points and mask of points inside of surface.
+        Points outside are extrapolated by plane of triangle nearest to them
+        """
+        x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+        triangles = self.find_triangles(x, y)
+        inside = triangles >= 0
+        outside = np.flatnonzero(~inside)
+        if len(outside):
+            triangles[outside] = self.nearest_triangles(x[outside], y[outside])
+        a, b, c = self.planes[triangles].T
+        return a * x + b * y + c, inside
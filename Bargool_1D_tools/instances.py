@@ -1,8 +1,22 @@
 import collections
+import locale
+import multiprocessing
+import os
+import sys
+import time
+import types
 
 import bpy
+from bpy.app.handlers import persistent
 from bpy_extras.io_utils import ExportHelper
-
+from mathutils import Matrix, Vector
+
+from .mesh_utils import (get_data_objects, build_data_objects_index, list_data_objects, add_indexed_object,
+                         get_mesh_fingerprint, forget_mesh, estimate_mesh_size, read_array,
+                         read_selected_objects, read_object_array)
+from .instances_utils import (np, InstanceTable, LocationGrid, iter_tables, open_text,
+                              points_triangles, INSTANCE_DTYPE,
+                              is_binary_file, get_byte_ranges, BINARY_EXT, GZIP_EXT, PARALLEL_RANGE_SIZE)
 from .utils import check_equality, OpenFileHelper, BatchOperatorMixin, draw_operator
 
 __author__ = 'Aleksey Nakoryakov'
@@ -17,26 +31,104 @@ def find_instances(obj, context):
     """ Finds instances of object obj """
     if not hasattr(obj.data, 'name'):
         return
-    mesh_name = obj.data.name
-    for o in filter_named_data(context.scene.objects):
-        if o.data.name == mesh_name:
-            yield o
+    for o in get_data_objects(context.scene, obj.data):
+        yield o
 
 
 def create_instance(obj, scene):
     """ Creates instance of obj """
     duplicated = obj.copy()
     scene.objects.link(duplicated)
+    add_indexed_object(scene, duplicated)
+    return duplicated
+
+
+def create_instances(obj, scene, count):
+    """ Creates count instances of obj at once """
+    duplicated = [obj.copy() for _ in range(count)]
+    for o in duplicated:
+        scene.objects.link(o)
+        add_indexed_object(scene, o)
     return duplicated
 
 
+def remove_object(scene, obj):
+    """ Unlinks object from scene and removes it from file """
+    scene.objects.unlink(obj)
+    bpy.data.objects.remove(obj)
+
+
 def filter_named_data(items):
     return [o for o in items if hasattr(o.data, 'name')]
 
 
+def get_unique_data(objects):
+    """ Data of objects, each datablock once """
+    return dict((o.data.as_pointer(), o.data) for o in filter_named_data(objects)).values()
+
+
+def modify_object(obj, location, scale, rotation):
+    """ Sets transform of instance record to object """
+    obj.location = location
+    obj.scale = scale
+    obj.rotation_euler[2] = rotation
+
+
+def iter_transforms(records):
+    """ Yields location, scale and rotation of instance records as python values """
+    return zip(records['location'].tolist(), records['scale'].tolist(), records['rotation'].tolist())
+
+
+# Face layers of point cloud mesh with exact transforms of instances
+POINTS_LAYERS = ('location_x', 'location_y', 'location_z', 'scale_x', 'scale_y', 'scale_z', 'rotation')
+
+
+def build_points_mesh(name, records):
+    """ Mesh of dupli faces, one triangle for each instance record """
+    count = len(records)
+    mesh = bpy.data.meshes.new(name)
+    mesh.vertices.add(count * 3)
+    co = points_triangles(records['location'], records['scale'], records['rotation'])
+    mesh.vertices.foreach_set('co', co.astype(np.float32).ravel())
+    mesh.loops.add(count * 3)
+    mesh.loops.foreach_set('vertex_index', np.arange(count * 3, dtype=np.int32))
+    mesh.polygons.add(count)
+    mesh.polygons.foreach_set('loop_start', np.arange(0, count * 3, 3, dtype=np.int32))
+    mesh.polygons.foreach_set('loop_total', np.full(count, 3, dtype=np.int32))
+    values = np.column_stack((records['location'], records['scale'], records['rotation']))
+    for i, layer_name in enumerate(POINTS_LAYERS):
+        layer = mesh.polygon_layers_float.new(layer_name)
+        layer.data.foreach_set('value', values[:, i].astype(np.float32))
+    mesh.update(calc_edges=True)
+    return mesh
+
+
+def read_points_records(mesh):
+    """ Instance records from face layers of point cloud mesh """
+    records = np.zeros(len(mesh.polygons), dtype=INSTANCE_DTYPE)
+    values = np.column_stack([read_array(mesh.polygon_layers_float[layer_name].data, 'value', np.float32)
+                              for layer_name in POINTS_LAYERS])
+    records['location'] = values[:, 0:3]
+    records['scale'] = values[:, 3:6]
+    records['rotation'] = values[:, 6]
+    return records
+
+
+def is_points_carrier(obj):
+    return (obj is not None and obj.type == 'MESH' and obj.dupli_type == 'FACES' and
+            POINTS_LAYERS[0] in obj.data.polygon_layers_float)
+
+
 class BlockInstance(object):
-    """ Class for operating with instances read from txt file """
+    """
+    Class for operating with instances read from txt file.
+    BlockInstance(table, index) is view of record of InstanceTable
+    """
     def __init__(self, *args):
+        if len(args) == 2 and isinstance(args[0], InstanceTable):
+            self.table, self.index = args
+            self.obname = None
+            return
         if len(args) == 1 and isinstance(args[0], collections.Iterable):
             s = args[0]
             s = s.strip(' ()')
@@ -55,15 +147,26 @@ class BlockInstance(object):
         self.rotation = float(args[7])
         self.obname = None
 
+    def __getattr__(self, attr):
+        # Called only for views, other instances have all attributes
+        if attr not in ('name', 'coords', 'scale', 'rotation') or 'table' not in self.__dict__:
+            raise AttributeError(attr)
+        record = self.table.records[self.index]
+        if attr == 'name':
+            return self.table.names[record['mesh']]
+        if attr == 'coords':
+            return record['location'].tolist()
+        if attr == 'scale':
+            return record['scale'].tolist()
+        return float(record['rotation'])
+
     def __check_name(self, obj):
         if obj.data.name != self.name:
             raise AttributeError("Mesh name not equals")
 
     def modify_obj(self, obj):
         self.__check_name(obj)
-        obj.location = self.coords
-        obj.scale = self.scale
-        obj.rotation_euler[2] = self.rotation
+        modify_object(obj, self.coords, self.scale, self.rotation)
 
     def is_equals_to_obj(self, obj, tolerance):
         self.__check_name(obj)
@@ -83,38 +186,259 @@ class BlockInstance(object):
                                                      sc=self.scale)
 
 
-def read_file(filepath):
+def get_record_name(line):
+    """ Mesh name of text record without parsing of transform """
+    return line.lstrip(' (').split(None, 1)[0]
+
+
+def iter_file(filepath, names=None, chunk_size=10000):
+    """
+    Reads file lazily and yields lists of at most chunk_size instances.
+    If names is given, records of other meshes are skipped before parsing
+    """
+    if np is not None:
+        for table in iter_tables(filepath, names, chunk_size):
+            yield [BlockInstance(table, i) for i in range(len(table))]
+        return
+    chunk = []
+    with open_text(filepath) as f:
+        for l in f:
+            if not l.startswith('('):
+                continue
+            if names is not None and get_record_name(l) not in names:
+                continue
+            chunk.append(BlockInstance(l))
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+def read_file(filepath, names=None):
     d = collections.defaultdict(list)
-    with open(filepath, 'r') as f:
-        lst = [BlockInstance(l) for l in f if l.startswith('(')]
-        for l in lst:
+    for chunk in iter_file(filepath, names):
+        for l in chunk:
             d[l.name].append(l)
     return d
 
 
 def write_file(filepath, items):
-    with open(filepath, 'w') as f:
-        f.writelines(["%s\n" % i for i in items])
+    """ Streams items to file, gzipped if its extension is .gz """
+    with open_text(filepath, 'w') as f:
+        f.writelines("%s\n" % i for i in items)
+
+
+# Objects are exported to text by chunks of this size
+EXPORT_CHUNK_SIZE = 100000
+TRANSFORM_FORMAT = '("%s"\t"%s"\t(%r %r %r)\t(%r %r %r)\t(%r %r %r))\n'
+MATRIX_FORMAT = '("%s"\t"%s"\t(' + ' '.join(['%r'] * 16) + '))\n'
+
+
+def read_selected_transforms(scene, use_matrix=False):
+    """
+    Selected visible objects with data and their transforms, read in bulk from all scene objects.
+    Transform of object is row of location, rotation and scale, or of world matrix by rows
+    """
+    objects = scene.objects
+    objects_list, indices = read_selected_objects(scene)
+    indices = [i for i in indices.tolist() if hasattr(objects_list[i].data, 'name')]
+    selected = [objects_list[i] for i in indices]
+    if use_matrix:
+        # Matrices are stored by columns
+        matrices = read_object_array(objects, 'matrix_world', 16)[indices]
+        return selected, matrices.reshape((-1, 4, 4)).transpose((0, 2, 1)).reshape((-1, 16))
+    return selected, np.column_stack([read_object_array(objects, attr, 3)[indices]
+                                      for attr in ('location', 'rotation_euler', 'scale')])
+
+
+def write_transforms(filepath, objects, transforms, use_matrix=False):
+    """ Streams text records of objects and their transforms by chunks """
+    fmt = MATRIX_FORMAT if use_matrix else TRANSFORM_FORMAT
+    with open_text(filepath, 'w') as f:
+        for start in range(0, len(objects), EXPORT_CHUNK_SIZE):
+            rows = transforms[start:start + EXPORT_CHUNK_SIZE].tolist()
+            f.writelines(fmt % ((o.name, o.data.name) + tuple(row))
+                         for o, row in zip(objects[start:start + EXPORT_CHUNK_SIZE], rows))
+
+
+def objects_to_table(objects, transforms):
+    """ InstanceTable of mesh names and transforms of objects from read_selected_transforms """
+    table = InstanceTable()
+    table.records = np.empty(len(objects), dtype=table.records.dtype)
+    table.records['mesh'] = [table.intern(o.data.name) for o in objects]
+    table.records['location'] = transforms[:, 0:3]
+    table.records['scale'] = transforms[:, 6:9]
+    table.records['rotation'] = transforms[:, 5]
+    return table
+
+
+def start_worker_pool():
+    """
+    Starts pool of python processes and returns it with module of their tasks.
+    The module is instances_utils imported as top level module, so processes can import it
+    by name without bpy and the add-on package. They get sys.path on start,
+    so directory of add-on is in sys.path only until then.
+    Processes also import file of __main__ module on start, which is bpy script
+    in Blender run with --python or from text editor, so they get bare module instead
+    """
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    is_added = package_dir not in sys.path
+    if is_added:
+        # Appended, so modules of add-on do not shadow standard ones
+        sys.path.append(package_dir)
+    main_module = sys.modules['__main__']
+    sys.modules['__main__'] = types.ModuleType('__main__')
+    try:
+        import instances_utils
+        context = multiprocessing.get_context('spawn')
+        # Blender executable is not python
+        context.set_executable(bpy.app.binary_path_python)
+        return instances_utils, context.Pool()
+    finally:
+        sys.modules['__main__'] = main_module
+        if is_added:
+            sys.path.remove(package_dir)
+
+
+def iter_parallel_tables(filepath, names=None):
+    """
+    Parses text file by byte ranges in pool of processes and yields tables in file order.
+    Small, gzipped and binary files are read in this process
+    """
+    if (filepath.endswith(GZIP_EXT) or is_binary_file(filepath) or
+            os.path.getsize(filepath) < 2 * PARALLEL_RANGE_SIZE):
+        for table in iter_tables(filepath, names):
+            yield table
+        return
+    names = None if names is None else set(names)
+    # The same encoding as open_text uses for files read in this process
+    encoding = locale.getpreferredencoding(False)
+    tasks = [(filepath, start, end, names, encoding) for start, end in get_byte_ranges(filepath)]
+    worker, pool = start_worker_pool()
+    try:
+        for table_names, records in pool.imap(worker.parse_range, tasks):
+            if len(records):
+                yield InstanceTable(table_names, records)
+    finally:
+        pool.terminate()
+
+
+class InstancesFileMixin(OpenFileHelper):
+    """ Mixin for operators reading instances files """
+    # Objects placed from file keep its path in this property, so they could be synced with it
+    source_key = 'instances_file'
+    filter_glob = bpy.props.StringProperty(default="*.txt;*" + GZIP_EXT + ";*" + BINARY_EXT,
+                                           options={'HIDDEN'})
+
+    use_parallel = bpy.props.BoolProperty(
+        name='Parallel parsing',
+        default=True,
+        description='Parses large text files in several processes')
 
+    def read_tables(self, names=None):
+        """ Yields InstanceTables of file with records of meshes from names """
+        if self.use_parallel:
+            return iter_parallel_tables(self.filepath, names)
+        return iter_tables(self.filepath, names)
 
-class ImportTextAsInstancesOperator(OpenFileHelper, bpy.types.Operator):
+    def get_source_path(self):
+        """ Absolute path of file, that is kept by placed objects """
+        return os.path.abspath(bpy.path.abspath(self.filepath))
+
+
+class ImportTextAsInstancesOperator(InstancesFileMixin, bpy.types.Operator):
     bl_idname = 'object.import_instances'
     bl_label = 'Place Instances'
     bl_options = {'REGISTER', 'UNDO'}
 
-    filter_glob = bpy.props.StringProperty(default="*.txt;",
-                                           options={'HIDDEN'})
+    use_bulk = bpy.props.BoolProperty(
+        name='Bulk creation',
+        default=True,
+        description='Creates instances of each mesh at once and reports time of each phase')
+
+    placement = bpy.props.EnumProperty(
+        items=[
+            ('OBJECTS', 'Objects', 'Object for each instance'),
+            ('POINTS', 'Point clouds', 'Object with face for each instance for each mesh. '
+                                       'Mesh is instanced on faces with Z rotation and mean scale'),
+        ],
+        name='Placement')
 
     def execute(self, context):
+        if self.placement == 'POINTS' and np is not None:
+            return self.place_points(context)
+        if self.use_bulk and np is not None:
+            return self.place_bulk(context)
         scene = context.scene
-        instances_dict = read_file(self.filepath)
-        objects = filter_named_data(scene.objects)
-        for obj in objects:
-            if obj.data.name in instances_dict:
-                instances = instances_dict.pop(obj.data.name)
-                for inst in instances:
-                    duplicated = create_instance(obj, scene)
+        source_path = self.get_source_path()
+        # Any object of each mesh is the source of its instances
+        objects = dict((users[0].data.name, users[0]) for users in list_data_objects(scene))
+        if np is None:
+            for chunk in iter_file(self.filepath, objects):
+                for inst in chunk:
+                    duplicated = create_instance(objects[inst.name], scene)
+                    duplicated[self.source_key] = source_path
                     inst.modify_obj(duplicated)
+            return {'FINISHED'}
+        for table in self.read_tables(objects):
+            for name, indices in table.group_by_mesh():
+                for transform in iter_transforms(table.records[indices]):
+                    duplicated = create_instance(objects[name], scene)
+                    duplicated[self.source_key] = source_path
+                    modify_object(duplicated, *transform)
+        return {'FINISHED'}
+
+    def place_points(self, context):
+        scene = context.scene
+        objects = dict((users[0].data.name, users[0]) for users in list_data_objects(scene))
+        table = InstanceTable.concatenate(self.read_tables(objects))
+        carriers_count = 0
+        for name, indices in table.group_by_mesh():
+            carrier_name = '{}_points'.format(name)
+            carrier = bpy.data.objects.new(carrier_name, build_points_mesh(carrier_name, table.records[indices]))
+            carrier.dupli_type = 'FACES'
+            carrier.use_dupli_faces_scale = True
+            scene.objects.link(carrier)
+            # Child of carrier is instanced on faces, its location is ignored
+            child = create_instance(objects[name], scene)
+            child.parent = carrier
+            child.matrix_parent_inverse.identity()
+            modify_object(child, (0, 0, 0), (1, 1, 1), 0)
+            carriers_count += 1
+        self.report({'INFO'}, 'Placed {} instances to {} point clouds'.format(len(table), carriers_count))
+        return {'FINISHED'}
+
+    def place_bulk(self, context):
+        scene = context.scene
+        source_path = self.get_source_path()
+        objects = dict((users[0].data.name, users[0]) for users in list_data_objects(scene))
+        timings = collections.OrderedDict((phase, 0.0) for phase in ('parse', 'copy', 'transform'))
+        count = 0
+        tables = self.read_tables(objects)
+        while True:
+            start = time.time()
+            table = next(tables, None)
+            timings['parse'] += time.time() - start
+            if table is None:
+                break
+            for name, indices in table.group_by_mesh():
+                source = objects[name]
+                records = table.records[indices]
+                start = time.time()
+                duplicated = create_instances(source, scene, len(records))
+                for obj in duplicated:
+                    obj[self.source_key] = source_path
+                timings['copy'] += time.time() - start
+                start = time.time()
+                # Values are written as they are, since Find and Sync compare them with file.
+                # Matrix would be decomposed to other angles and scales of the same transform
+                for obj, transform in zip(duplicated, iter_transforms(records)):
+                    modify_object(obj, *transform)
+                timings['transform'] += time.time() - start
+                count += len(records)
+        self.report({'INFO'}, 'Placed {} instances. {}'.format(
+            count, ', '.join('{} {:.2f}s'.format(phase, t) for phase, t in timings.items())))
         return {'FINISHED'}
 
 
@@ -125,35 +449,225 @@ class ExportInstancesAsTextOperator(ExportHelper, bpy.types.Operator):
 
     filename_ext = ".txt"
 
+    file_format = bpy.props.EnumProperty(
+        items=[
+            ('TEXT', 'Text', 'Text with object names and full rotation, gzipped if file name ends with .gz'),
+            ('BINARY', 'Binary', 'Binary records of mesh names, locations, scales and Z rotations, '
+                                 'that are read much faster'),
+        ],
+        name='Format')
+
+    use_matrix = bpy.props.BoolProperty(
+        name='World matrices',
+        default=False,
+        description='Text has world matrix of each object by rows instead of location, rotation and scale')
+
+    def check(self, context):
+        if self.file_format == 'TEXT' and self.filepath.endswith(GZIP_EXT):
+            # ExportHelper would replace .gz with .txt
+            return False
+        self.filename_ext = BINARY_EXT if self.file_format == 'BINARY' else '.txt'
+        return ExportHelper.check(self, context)
+
     def execute(self, context):
-        objects = [BlockInstance(obj) for obj in filter_named_data(context.selected_objects)]
-        write_file(self.filepath, objects)
+        if self.file_format == 'BINARY' and self.use_matrix:
+            self.report({'ERROR'}, 'Binary format keeps only Z rotation, it can not have world matrices')
+            return {'CANCELLED'}
+        if np is None:
+            if self.file_format == 'BINARY' or self.use_matrix:
+                self.report({'ERROR'}, 'Binary format and world matrices need numpy')
+                return {'CANCELLED'}
+            write_file(self.filepath, (BlockInstance(obj) for obj in filter_named_data(context.selected_objects)))
+            return {'FINISHED'}
+        if self.file_format == 'BINARY':
+            objects, transforms = read_selected_transforms(context.scene)
+            with open(self.filepath, 'wb') as f:
+                objects_to_table(objects, transforms).write_binary(f)
+            return {'FINISHED'}
+        objects, transforms = read_selected_transforms(context.scene, self.use_matrix)
+        write_transforms(self.filepath, objects, transforms, self.use_matrix)
         return {'FINISHED'}
 
 
-class FindInstancesFromText(OpenFileHelper, bpy.types.Operator):
+class FindInstancesFromText(InstancesFileMixin, bpy.types.Operator):
     bl_idname = 'object.find_instances'
     bl_label = 'Find Instances'
     bl_options = {'REGISTER', 'UNDO'}
 
-    filter_glob = bpy.props.StringProperty(default="*.txt;",
-                                           options={'HIDDEN'})
-
     def execute(self, context):
         tolerance = context.scene.tool_settings.double_threshold
         scene = context.scene
-        instances_dict = read_file(self.filepath)
-        objects = filter_named_data(scene.objects)
-        for obj in objects:
-            if obj.data.name in instances_dict:
-                d = instances_dict[obj.data.name]
-                for index, item in enumerate(d):
+        if np is not None:
+            self.find_in_table(scene, tolerance)
+            return {'FINISHED'}
+        # Scene objects, that are not found yet, by mesh name.
+        # File is streamed, so only they are kept in memory
+        objects = collections.defaultdict(list)
+        for obj in filter_named_data(scene.objects):
+            objects[obj.data.name].append(obj)
+        for chunk in iter_file(self.filepath, objects):
+            for item in chunk:
+                candidates = objects[item.name]
+                for index, obj in enumerate(candidates):
                     if item.is_equals_to_obj(obj, tolerance):
                         obj.select = True
-                        d.pop(index)
+                        candidates.pop(index)
                         break
         return {'FINISHED'}
 
+    def find_in_table(self, scene, tolerance):
+        """ Each object takes first equal record of its mesh, that is not taken yet """
+        objects = filter_named_data(scene.objects)
+        table = InstanceTable.concatenate(self.read_tables(set(o.data.name for o in objects)))
+        grid = LocationGrid(table, tolerance)
+        for obj in objects:
+            if grid.take(obj.data.name, tuple(obj.location), tuple(obj.scale),
+                         obj.rotation_euler[2]) is not None:
+                obj.select = True
+
+
+class SyncInstancesOperator(InstancesFileMixin, bpy.types.Operator):
+    bl_idname = 'object.sync_instances'
+    bl_label = 'Sync Instances'
+    bl_description = ('Updates instances placed or synced from changed file: '
+                      'creates new, moves changed and removes missing ones')
+    bl_options = {'REGISTER', 'UNDO'}
+
+    @classmethod
+    def poll(cls, context):
+        return np is not None
+
+    def execute(self, context):
+        scene = context.scene
+        filepath = self.get_source_path()
+        tolerance = scene.tool_settings.double_threshold
+        objects = collections.defaultdict(list)
+        for users in list_data_objects(scene):
+            objects[users[0].data.name].extend(users)
+        table = InstanceTable.concatenate(self.read_tables(objects))
+        grid = LocationGrid(table, tolerance)
+        # Objects of this file without equal records by mesh name
+        unmatched = collections.defaultdict(list)
+        for name, users in objects.items():
+            for obj in users:
+                if grid.take(name, tuple(obj.location), tuple(obj.scale), obj.rotation_euler[2]) is None:
+                    # Objects not placed from this file are never moved or removed
+                    if obj.get(self.source_key) == filepath:
+                        unmatched[name].append(obj)
+        # Records without equal objects are new or changed
+        changed = InstanceTable(table.names, table.records[~grid.taken])
+        moved_count = created_count = removed_count = 0
+        for name, indices in changed.group_by_mesh():
+            records = changed.records[indices]
+            users = unmatched.pop(name, [])
+            moved = users[:len(records)]
+            del users[:len(records)]
+            if users:
+                unmatched[name] = users
+            created = create_instances(objects[name][0], scene, len(records) - len(moved))
+            for obj in created:
+                obj[self.source_key] = filepath
+            for obj, transform in zip(moved + created, iter_transforms(records)):
+                modify_object(obj, *transform)
+            moved_count += len(moved)
+            created_count += len(created)
+        for users in unmatched.values():
+            for obj in users:
+                remove_object(scene, obj)
+                removed_count += 1
+        self.report({'INFO'}, 'Created {}, moved {}, removed {} instances'.format(
+            created_count, moved_count, removed_count))
+        return {'FINISHED'}
+
+
+class WatchInstancesFileOperator(InstancesFileMixin, bpy.types.Operator):
+    bl_idname = 'object.watch_instances_file'
+    bl_label = 'Watch Instances File'
+    bl_description = 'Syncs instances every time the file is changed, until watching is stopped'
+
+    # Seconds between checks of file modification time
+    interval = 1.0
+    is_watching = False
+
+    @classmethod
+    def poll(cls, context):
+        return np is not None and not cls.is_watching
+
+    def execute(self, context):
+        self.mtime = None
+        self.failed_mtime = None
+        self.timer = context.window_manager.event_timer_add(self.interval, window=context.window)
+        context.window_manager.modal_handler_add(self)
+        WatchInstancesFileOperator.is_watching = True
+        return {'RUNNING_MODAL'}
+
+    def modal(self, context, event):
+        if not WatchInstancesFileOperator.is_watching:
+            self.cancel(context)
+            return {'CANCELLED'}
+        if event.type != 'TIMER':
+            return {'PASS_THROUGH'}
+        try:
+            self.check_file()
+        except Exception:
+            # Watching could not go on, so timer is removed and watching could be started again
+            self.cancel(context)
+            raise
+        return {'PASS_THROUGH'}
+
+    def cancel(self, context):
+        context.window_manager.event_timer_remove(self.timer)
+        WatchInstancesFileOperator.is_watching = False
+
+    def check_file(self):
+        """ Syncs instances, if file is changed since last successful sync """
+        try:
+            mtime = os.path.getmtime(self.filepath)
+        except OSError:
+            # File is being rewritten
+            return
+        if mtime == self.mtime:
+            return
+        try:
+            bpy.ops.object.sync_instances(filepath=self.filepath, use_parallel=self.use_parallel)
+        except RuntimeError as e:
+            # File could be read while it is written, so it is synced again on the next check
+            if mtime != self.failed_mtime:
+                self.failed_mtime = mtime
+                self.report({'WARNING'}, 'Could not sync instances, will retry: {}'.format(e))
+            return
+        self.mtime = mtime
+
+
+@persistent
+def stop_watching(*args):
+    """ Modal handlers are dropped on file load, so watching is not running then """
+    WatchInstancesFileOperator.is_watching = False
+
+
+def register_handlers():
+    bpy.app.handlers.load_post.append(stop_watching)
+
+
+def unregister_handlers():
+    # Handler of reloaded module is other function, so compare names
+    for h in [h for h in bpy.app.handlers.load_post if h.__name__ == stop_watching.__name__]:
+        bpy.app.handlers.load_post.remove(h)
+    stop_watching()
+
+
+class StopWatchingInstancesFileOperator(bpy.types.Operator):
+    bl_idname = 'object.stop_watching_instances_file'
+    bl_label = 'Stop Watching'
+
+    @classmethod
+    def poll(cls, context):
+        return WatchInstancesFileOperator.is_watching
+
+    def execute(self, context):
+        WatchInstancesFileOperator.is_watching = False
+        return {'FINISHED'}
+
 
 class DropInstancesOperator(bpy.types.Operator):
     bl_idname = 'object.drop_instances'
@@ -223,11 +737,9 @@ class SelectInstancesOperator(bpy.types.Operator):
 
     def execute(self, context):
         scene = context.scene
-        selected_objects = filter_named_data(context.selected_objects)
-        mesh_names = set([o.data.name for o in selected_objects])
-        objects_to_select = [obj for obj in filter_named_data(scene.objects) if obj.data.name in mesh_names]
-        for obj in objects_to_select:
-            obj.select = True
+        for data in get_unique_data(context.selected_objects):
+            for obj in get_data_objects(scene, data):
+                obj.select = True
         return {'FINISHED'}
 
 
@@ -241,7 +753,8 @@ class FilterInstancesOperator(BatchOperatorMixin, bpy.types.Operator):
     mesh_names = {}
 
     def pre_filter_objects(self):
-        self.objects = filter_named_data(self.objects)
+        self.objects = [obj for data in get_unique_data(self.selected_objects)
+                        for obj in get_data_objects(self.context.scene, data)]
         self.mesh_names = set([o.data.name for o in filter_named_data(self.selected_objects)])
 
     def filter_object(self, obj):
@@ -262,17 +775,128 @@ class DeselectInstancesOperator(BatchOperatorMixin, bpy.types.Operator):
         obj.select = False
 
 
+class MergeIdenticalMeshesOperator(bpy.types.Operator):
+    bl_idname = 'object.merge_identical_meshes'
+    bl_label = 'Merge Identical Meshes'
+    bl_description = ('Makes selected objects with identical geometry instances of one mesh '
+                      'and removes other meshes')
+    bl_options = {'REGISTER', 'UNDO'}
+
+    use_ignore_offset = bpy.props.BoolProperty(
+        name='Ignore offset',
+        default=False,
+        description='Merges meshes, that are equal with merge threshold up to offset in local space. '
+                    'Objects are moved to keep their geometry in place')
+
+    @classmethod
+    def poll(cls, context):
+        return np is not None and context.selected_objects
+
+    def execute(self, context):
+        scene = context.scene
+        precision = scene.tool_settings.double_threshold if self.use_ignore_offset else None
+        groups = collections.defaultdict(list)
+        weighted = 0
+        for mesh in get_unique_data(o for o in context.selected_objects if o.type == 'MESH'):
+            # Weights are stored in mesh, but their groups in objects, so they are not compared
+            if any(o.vertex_groups for o in get_data_objects(scene, mesh)):
+                weighted += 1
+                continue
+            fingerprint, lower = get_mesh_fingerprint(mesh, precision)
+            groups[fingerprint].append((mesh, lower))
+        groups = [group for group in groups.values() if len(group) > 1]
+        # Users are found before relinking, which makes index stale
+        users = dict((mesh.as_pointer(), get_data_objects(scene, mesh))
+                     for group in groups for mesh, _ in group[1:])
+        merged_count = reclaimed = 0
+        for group in groups:
+            shared, shared_lower = group[0]
+            for mesh, lower in group[1:]:
+                offset = Vector(lower - shared_lower)
+                for obj in users[mesh.as_pointer()]:
+                    if offset.length:
+                        # World geometry stays in place: M * v = M * T(offset) * shared_v
+                        obj.matrix_world = obj.matrix_world * Matrix.Translation(offset)
+                    obj.data = shared
+                merged_count += 1
+                # Mesh is kept, if it has users out of scene
+                if not mesh.users:
+                    reclaimed += estimate_mesh_size(mesh)
+                    forget_mesh(mesh)
+                    bpy.data.meshes.remove(mesh)
+        self.report({'INFO'}, 'Replaced {} meshes with {} shared ones, reclaimed about {:.1f} MB'.format(
+            merged_count, len(groups), reclaimed / float(1 << 20)))
+        if weighted:
+            self.report({'WARNING'}, 'Skipped {} meshes with vertex groups'.format(weighted))
+        return {'FINISHED'}
+
+
+class RealizeInstancePointsOperator(bpy.types.Operator):
+    bl_idname = 'object.realize_instance_points'
+    bl_label = 'Realize Selected Points'
+    bl_description = 'Creates objects for selected faces of active point cloud and removes these faces'
+    bl_options = {'REGISTER', 'UNDO'}
+
+    @classmethod
+    def poll(cls, context):
+        return np is not None and is_points_carrier(context.active_object)
+
+    def execute(self, context):
+        scene = context.scene
+        carrier = context.active_object
+        if not carrier.children:
+            self.report({'ERROR'}, 'Point cloud has no instanced object')
+            return {'CANCELLED'}
+        is_edit_mode = carrier.mode == 'EDIT'
+        if is_edit_mode:
+            # Selection of faces is written to mesh on leaving edit mode
+            bpy.ops.object.mode_set(mode='OBJECT')
+        mesh = carrier.data
+        records = read_points_records(mesh)
+        select = read_array(mesh.polygons, 'select', np.bool_)
+        realized = create_instances(carrier.children[0], scene, int(np.count_nonzero(select)))
+        for obj, transform in zip(realized, iter_transforms(records[select])):
+            obj.parent = None
+            modify_object(obj, *transform)
+        if len(realized):
+            carrier.data = build_points_mesh(mesh.name, records[~select])
+            if not mesh.users:
+                bpy.data.meshes.remove(mesh)
+        if is_edit_mode:
+            bpy.ops.object.mode_set(mode='EDIT')
+        self.report({'INFO'}, 'Realized {} instances'.format(len(realized)))
+        return {'FINISHED'}
+
+
+class RebuildInstancesIndexOperator(bpy.types.Operator):
+    bl_idname = 'object.rebuild_instances_index'
+    bl_label = 'Rebuild Instances Index'
+    bl_description = 'Rebuilds index of objects by their data, that is used by instances operators'
+
+    def execute(self, context):
+        index = build_data_objects_index(context.scene)
+        self.report({'INFO'}, 'Indexed {} objects of {} datablocks'.format(
+            sum(len(objects) for objects in index.values()), len(index)))
+        return {'FINISHED'}
+
+
 def create_panel(col):
     operators = [
         ImportTextAsInstancesOperator.bl_idname,
         ExportInstancesAsTextOperator.bl_idname,
         FindInstancesFromText.bl_idname,
+        SyncInstancesOperator.bl_idname,
+        WatchInstancesFileOperator.bl_idname,
+        StopWatchingInstancesFileOperator.bl_idname,
         (SelectInstancesOperator.bl_idname, 'Select Instances'),
         (FilterInstancesOperator.bl_idname, 'Filter Instances'),
         DeselectInstancesOperator.bl_idname,
         DropInstancesOperator.bl_idname,
         InstancesToCursourOperator.bl_idname,
         CombineOperator.bl_idname,
+        MergeIdenticalMeshesOperator.bl_idname,
+        RealizeInstancePointsOperator.bl_idname,
+        RebuildInstancesIndexOperator.bl_idname,
     ]
     for op in operators:
         draw_operator(col, op)
@@ -0,0 +1,312 @@
+"""
+Array-backed storage of instances read from files.
+Module does not use bpy, so it can be used by plain python processes
+"""
+import gzip
+import io
+import itertools
+import os
+import struct
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+__author__ = 'Aleksey Nakoryakov'
+
+# Record of instance: index of mesh name in table names and transform
+INSTANCE_DTYPE = np and np.dtype([('mesh', np.int32),
+                                  ('location', np.float64, (3,)),
+                                  ('scale', np.float64, (3,)),
+                                  ('rotation', np.float64)])
+# Numbers in text record after mesh name
+RECORD_VALUES = 7
+
+# Text files are read and written through buffer of this size
+BUFFER_SIZE = 1 << 20
+GZIP_EXT = '.gz'
+# Text files are parsed in parallel by byte ranges of about this size
+PARALLEL_RANGE_SIZE = 16 << 20
+
+# Binary file is header, mesh directory, utf-8 mesh names and records grouped by mesh.
+# Records of mesh are directory start:start + count
+BINARY_MAGIC = b'B1DINST\0'
+BINARY_VERSION = 1
+BINARY_EXT = '.inst'
+HEADER_FORMAT = '<8sIIQ'
+DIRECTORY_DTYPE = np and np.dtype([('start', '<u8'), ('count', '<u8'), ('name_size', '<u4')])
+RECORD_DTYPE = np and np.dtype([('location', '<f8', (3,)),
+                                ('scale', '<f8', (3,)),
+                                ('rotation', '<f8')])
+
+
+class InstanceTable(object):
+    """
+    Instances as structured array of transforms with mesh names interned to names list.
+    Instance costs size of its record, not of python objects
+    """
+    def __init__(self, names=(), records=None):
+        self.names = list(names)
+        self._name_index = dict((name, i) for i, name in enumerate(self.names))
+        if records is None:
+            records = np.zeros(0, dtype=INSTANCE_DTYPE)
+        self.records = records
+
+    def __len__(self):
+        return len(self.records)
+
+    def intern(self, name):
+        """ Index of mesh name in names. Name is added if it is new """
+        index = self._name_index.get(name)
+        if index is None:
+            index = self._name_index[name] = len(self.names)
+            self.names.append(name)
+        return index
+
+    def get_mesh_index(self, name):
+        """ Index of mesh name in names or None """
+        return self._name_index.get(name)
+
+    @classmethod
+    def from_lines(cls, lines, names=None):
+        """
+        Parses text records "(name x y z sx sy sz rot)".
+        Only name is split off in python, numbers are parsed in one call.
+        If names is given, records of other meshes are skipped
+        """
+        table = cls()
+        meshes = []
+        values = []
+        for l in lines:
+            if not l.startswith('('):
+                continue
+            name, value = l.strip(' ()\r\n').split(None, 1)
+            if names is not None and name not in names:
+                continue
+            meshes.append(table.intern(name))
+            values.append(value)
+        if not values:
+            return table
+        numbers = np.fromstring(' '.join(values), dtype=np.float64, sep=' ')
+        if numbers.size != len(values) * RECORD_VALUES:
+            raise ValueError('Instance records must have {} numbers after name'.format(RECORD_VALUES))
+        numbers = numbers.reshape((-1, RECORD_VALUES))
+        table.records = np.empty(len(meshes), dtype=INSTANCE_DTYPE)
+        table.records['mesh'] = meshes
+        table.records['location'] = numbers[:, 0:3]
+        table.records['scale'] = numbers[:, 3:6]
+        table.records['rotation'] = numbers[:, 6]
+        return table
+
+    @classmethod
+    def concatenate(cls, tables):
+        """ Joins tables to one with common names """
+        table = cls()
+        parts = []
+        for other in tables:
+            part = other.records.copy()
+            if len(other.names):
+                remap = np.array([table.intern(name) for name in other.names], dtype=np.int32)
+                part['mesh'] = remap[part['mesh']]
+            parts.append(part)
+        if parts:
+            table.records = np.concatenate(parts)
+        return table
+
+    def group_by_mesh(self):
+        """ Yields mesh name and indices of its records in file order """
+        if not len(self.records):
+            return
+        order = np.argsort(self.records['mesh'], kind='mergesort')
+        bounds = np.flatnonzero(np.diff(self.records['mesh'][order])) + 1
+        for indices in np.split(order, bounds):
+            yield self.names[self.records['mesh'][indices[0]]], indices
+
+    def match(self, indices, location, scale, rotation, tolerance):
+        """
+        Mask of records with indices, that are equal to transform with tolerance,
+        as check_equality does for each number
+        """
+        records = self.records[indices]
+        return ((np.abs(records['location'] - location) <= tolerance).all(axis=1) &
+                (np.abs(records['scale'] - scale) <= tolerance).all(axis=1) &
+                (np.abs(records['rotation'] - rotation) <= tolerance))
+
+    def write_binary(self, f):
+        """ Writes records in binary format, grouped by mesh """
+        groups = list(self.group_by_mesh())
+        directory = np.zeros(len(groups), dtype=DIRECTORY_DTYPE)
+        encoded_names = [name.encode('utf-8') for name, _ in groups]
+        directory['count'] = [len(indices) for _, indices in groups]
+        directory['start'][1:] = np.cumsum(directory['count'])[:-1]
+        directory['name_size'] = [len(name) for name in encoded_names]
+        f.write(struct.pack(HEADER_FORMAT, BINARY_MAGIC, BINARY_VERSION, len(groups), len(self)))
+        f.write(directory.tobytes())
+        f.write(b''.join(encoded_names))
+        # Records are aligned to float size
+        f.write(b'\0' * (-f.tell() % 8))
+        for _, indices in groups:
+            records = self.records[indices]
+            binary = np.empty(len(records), dtype=RECORD_DTYPE)
+            for field in RECORD_DTYPE.names:
+                binary[field] = records[field]
+            f.write(binary.tobytes())
+
+
+class LocationGrid(object):
+    """
+    Records of table hashed by mesh and location to cells of tolerance size.
+    Records equal to transform with tolerance are in 27 cells around its location,
+    so each lookup costs the same for any count of records of mesh
+    """
+    def __init__(self, table, tolerance):
+        self.table = table
+        self.tolerance = tolerance
+        # Any cell size works for exact matching
+        self.cell_size = tolerance * (1 + 1e-6) if tolerance > 0 else 1.0
+        self.taken = np.zeros(len(table), dtype=np.bool_)
+        self.cells = {}
+        if not len(table):
+            return
+        keys = np.empty((len(table), 4), dtype=np.int64)
+        keys[:, 0] = table.records['mesh']
+        keys[:, 1:] = np.floor(table.records['location'] / self.cell_size)
+        # lexsort is stable, so indices in cell are ascending
+        self.order = np.lexsort(keys.T[::-1])
+        keys = keys[self.order]
+        starts = np.concatenate(([0], np.flatnonzero((np.diff(keys, axis=0) != 0).any(axis=1)) + 1))
+        ends = np.append(starts[1:], len(table))
+        self.cells = dict(zip(map(tuple, keys[starts].tolist()), zip(starts.tolist(), ends.tolist())))
+
+    def take(self, name, location, scale, rotation):
+        """
+        Finds first record, that is equal to transform and is not taken yet, and marks it taken.
+        Returns index of record or None
+        """
+        mesh = self.table.get_mesh_index(name)
+        if mesh is None:
+            return None
+        x, y, z = (int(c) for c in np.floor(np.array(location, dtype=np.float64) / self.cell_size))
+        candidates = []
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for dz in (-1, 0, 1):
+                    cell = self.cells.get((mesh, x + dx, y + dy, z + dz))
+                    if cell is not None:
+                        candidates.append(self.order[cell[0]:cell[1]])
+        if not candidates:
+            return None
+        indices = np.concatenate(candidates)
+        indices = indices[~self.taken[indices]]
+        indices = indices[self.table.match(indices, location, scale, rotation, self.tolerance)]
+        if not len(indices):
+            return None
+        index = int(indices.min())
+        self.taken[index] = True
+        return index
+
+
+def open_text(filepath, mode='r'):
+    """ Opens text instances file with large buffer. File is gzipped if its extension is .gz """
+    if not filepath.endswith(GZIP_EXT):
+        return open(filepath, mode, buffering=BUFFER_SIZE)
+    raw = gzip.open(filepath, mode + 'b')
+    if mode == 'r':
+        return io.TextIOWrapper(io.BufferedReader(raw, BUFFER_SIZE))
+    return io.TextIOWrapper(io.BufferedWriter(raw, BUFFER_SIZE))
+
+
+def points_triangles(location, scale, rotation):
+    """
+    Triangles for dupli faces, one per instance: centered at location, with first edge
+    along Z rotation and area equal to square of mean scale, so face scaling gives it.
+    Returns vertices, three per triangle
+    """
+    size = np.abs(np.prod(scale, axis=1)) ** (1.0 / 3)
+    u = np.column_stack((np.cos(rotation), np.sin(rotation), np.zeros(len(rotation)))) * size[:, np.newaxis]
+    w = np.column_stack((-u[:, 1], u[:, 0], np.zeros(len(rotation)))) / 3
+    # Counter-clockwise, so normal is Z and centroid is location. Area is 0.5 * 2 * 3 * |u| * |w|
+    return np.concatenate((location - u - w, location + u - w, location + 2 * w), axis=1).reshape((-1, 3))
+
+
+def is_binary_file(filepath):
+    """ Checks magic of binary instances file """
+    with open(filepath, 'rb') as f:
+        return f.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+
+
+def iter_binary_tables(filepath, names=None, chunk_size=100000):
+    """
+    Maps binary file to memory and yields tables of at most chunk_size records of one mesh.
+    Records of meshes out of names are not read from disk at all
+    """
+    with open(filepath, 'rb') as f:
+        _, version, names_count, records_count = struct.unpack(
+            HEADER_FORMAT, f.read(struct.calcsize(HEADER_FORMAT)))
+        if version != BINARY_VERSION:
+            raise ValueError('Unsupported instances file version {}'.format(version))
+        if not records_count:
+            return
+        directory = np.frombuffer(f.read(DIRECTORY_DTYPE.itemsize * names_count), dtype=DIRECTORY_DTYPE)
+        mesh_names = [f.read(size).decode('utf-8') for size in directory['name_size'].tolist()]
+        offset = f.tell() + (-f.tell() % 8)
+    records = np.memmap(filepath, dtype=RECORD_DTYPE, mode='r', offset=offset, shape=(records_count,))
+    for name, start, count in zip(mesh_names, directory['start'].tolist(), directory['count'].tolist()):
+        if names is not None and name not in names:
+            continue
+        for chunk_start in range(start, start + count, chunk_size):
+            chunk = records[chunk_start:min(chunk_start + chunk_size, start + count)]
+            table = InstanceTable([name], np.empty(len(chunk), dtype=INSTANCE_DTYPE))
+            table.records['mesh'] = 0
+            for field in RECORD_DTYPE.names:
+                table.records[field] = chunk[field]
+            yield table
+
+
+def iter_tables(filepath, names=None, chunk_size=100000):
+    """
+    Reads text or binary file lazily and yields tables of at most chunk_size records.
+    If names is given, records of other meshes are skipped
+    """
+    if is_binary_file(filepath):
+        for table in iter_binary_tables(filepath, names, chunk_size):
+            yield table
+        return
+    with open_text(filepath) as f:
+        while True:
+            lines = list(itertools.islice(f, chunk_size))
+            if not lines:
+                break
+            table = InstanceTable.from_lines(lines, names)
+            if len(table):
+                yield table
+
+
+def get_byte_ranges(filepath, range_size=PARALLEL_RANGE_SIZE):
+    """ Splits file to (start, end) byte ranges of about range_size, ending at line ends """
+    size = os.path.getsize(filepath)
+    bounds = [0]
+    with open(filepath, 'rb') as f:
+        while bounds[-1] + range_size < size:
+            f.seek(bounds[-1] + range_size)
+            # The rest of line belongs to this range
+            f.readline()
+            bounds.append(f.tell())
+    if bounds[-1] < size:
+        bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def parse_range(task):
+    """
+    Parses byte range of text file. It is run by worker processes,
+    so it returns mesh names and records, that are cheap to send back.
+    Encoding is given by caller, as locale of worker could differ
+    """
+    filepath, start, end, names, encoding = task
+    with open(filepath, 'rb') as f:
+        f.seek(start)
+        lines = f.read(end - start).decode(encoding).splitlines()
+    table = InstanceTable.from_lines(lines, names)
+    return table.names, table.records
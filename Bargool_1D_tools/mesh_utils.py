@@ -0,0 +1,455 @@
+"""
+Bulk access to mesh data with numpy and caches of values calculated from meshes.
+Blender ships numpy, but if it is absent, callers must use their per-vertex paths
+"""
+import collections
+import hashlib
+import itertools
+
+import bmesh
+import bpy
+from bpy.app.handlers import persistent
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+__author__ = 'Aleksey Nakoryakov'
+
+# Geometry edit counters of meshes with cached values by pointer
+_mesh_versions = collections.Counter()
+# Pointers of meshes refreshed without geometry changes since last scene update
+_quiet_updates = set()
+# Count of meshes at last scene update. Removed meshes are looked for, when it decreases
+_meshes_count = [0]
+# Dicts created by mesh_cache
+_caches = []
+# Objects count, objects by data pointer and users of data by data pointer
+# for scenes by pointer
+_data_objects = {}
+
+
+def get_mesh_version(mesh):
+    """ Edit counter of mesh. It changes every time geometry of mesh with cached values is updated """
+    return _mesh_versions[mesh.as_pointer()]
+
+
+def mesh_cache():
+    """
+    Creates dict for values calculated from meshes.
+    Pointers are not valid after file load or undo, so it is cleared then
+    """
+    cache = {}
+    _caches.append(cache)
+    return cache
+
+
+def is_cached(pointer):
+    """ Whether any cache has values of mesh by pointer """
+    return any(pointer in cache for cache in _caches)
+
+
+@persistent
+def count_mesh_updates(scene):
+    meshes = bpy.data.meshes
+    count = len(meshes)
+    # Handler runs on every update, so nothing is scanned until caches are used
+    if any(_caches):
+        if meshes.is_updated:
+            # Flags are read in bulk, then only updated meshes are visited
+            updated = np.empty(count, dtype=np.bool_)
+            meshes.foreach_get('is_updated', updated)
+            updated_data = np.empty(count, dtype=np.bool_)
+            meshes.foreach_get('is_updated_data', updated_data)
+            for index in np.flatnonzero(updated | updated_data).tolist():
+                pointer = meshes[index].as_pointer()
+                if pointer not in _quiet_updates and is_cached(pointer):
+                    _mesh_versions[pointer] += 1
+        if count < _meshes_count[0]:
+            alive = set(m.as_pointer() for m in meshes)
+            for pointer in set(itertools.chain.from_iterable(_caches)) - alive:
+                forget_pointer(pointer)
+    _meshes_count[0] = count
+    _quiet_updates.clear()
+
+
+@persistent
+def clear_mesh_caches(*args):
+    _mesh_versions.clear()
+    _quiet_updates.clear()
+    _data_objects.clear()
+    for cache in _caches:
+        cache.clear()
+
+
+def register_handlers():
+    bpy.app.handlers.scene_update_post.append(count_mesh_updates)
+    for handlers in (bpy.app.handlers.load_post, bpy.app.handlers.undo_post,
+                     bpy.app.handlers.redo_post):
+        handlers.append(clear_mesh_caches)
+
+
+def unregister_handlers():
+    for handlers, handler in ((bpy.app.handlers.scene_update_post, count_mesh_updates),
+                              (bpy.app.handlers.load_post, clear_mesh_caches),
+                              (bpy.app.handlers.undo_post, clear_mesh_caches),
+                              (bpy.app.handlers.redo_post, clear_mesh_caches)):
+        # Handlers of reloaded module are other functions, so compare names
+        for h in [h for h in handlers if h.__name__ == handler.__name__]:
+            handlers.remove(h)
+
+
+def build_data_objects_index(scene):
+    """ Builds index of scene objects by their data. Returns it as dict by data pointer """
+    index = collections.defaultdict(list)
+    users = {}
+    for obj in scene.objects:
+        if obj.data is not None:
+            data_pointer = obj.data.as_pointer()
+            index[data_pointer].append(obj)
+            users[data_pointer] = obj.data.users
+    _data_objects[scene.as_pointer()] = [len(scene.objects), index, users]
+    return index
+
+
+def get_data_objects_entry(scene):
+    """ Index entry of scene. It is rebuilt if count of objects changed """
+    entry = _data_objects.get(scene.as_pointer())
+    if entry is None or entry[0] != len(scene.objects):
+        build_data_objects_index(scene)
+        entry = _data_objects[scene.as_pointer()]
+    return entry
+
+
+def get_data_objects_index(scene):
+    """ Index of scene objects by data. It is rebuilt if count of objects changed """
+    return get_data_objects_entry(scene)[1]
+
+
+def is_indexed(entry, pointer, objects):
+    """
+    Checks, that objects are still listed with their data in index entry.
+    Objects changing their data change users of data, so it is compared to users at indexing
+    """
+    return all(o.data is not None and o.data.as_pointer() == pointer for o in objects) and (
+        not objects or objects[0].data.users == entry[2].get(pointer))
+
+
+def get_data_objects(scene, data):
+    """ Objects of scene using data """
+    pointer = data.as_pointer()
+    entry = get_data_objects_entry(scene)
+    objects = entry[1].get(pointer, [])
+    try:
+        if is_indexed(entry, pointer, objects):
+            return list(objects)
+    except ReferenceError:
+        pass
+    return list(build_data_objects_index(scene).get(pointer, []))
+
+
+def list_data_objects(scene):
+    """ Lists of scene objects using the same data, one list for each data """
+    entry = get_data_objects_entry(scene)
+    try:
+        # Only the first object of each list is checked, to keep it cheap for many objects
+        if all(is_indexed(entry, pointer, objects[:1]) for pointer, objects in entry[1].items()):
+            return [objects for objects in entry[1].values() if objects]
+    except ReferenceError:
+        pass
+    return [objects for objects in build_data_objects_index(scene).values() if objects]
+
+
+def add_indexed_object(scene, obj):
+    """ Adds object, that is linked to scene, to index, so index stays valid """
+    entry = _data_objects.get(scene.as_pointer())
+    if entry is not None and obj.data is not None:
+        entry[0] += 1
+        entry[1][obj.data.as_pointer()].append(obj)
+        entry[2][obj.data.as_pointer()] = obj.data.users
+
+
+def read_vertex_co(mesh):
+    """ Reads coordinates of all mesh vertices in bulk """
+    count = len(mesh.vertices)
+    co = np.empty(count * 3, dtype=np.float32)
+    mesh.vertices.foreach_get('co', co)
+    # Calculations are in python floats precision as in per-vertex code
+    return co.reshape((count, 3)).astype(np.float64)
+
+
+def write_vertex_co(mesh, co):
+    """ Writes coordinates of all mesh vertices in one call """
+    mesh.vertices.foreach_set('co', co.astype(np.float32).ravel())
+    mesh.update()
+
+
+def read_vertex_flags(mesh):
+    """ Reads hide and select flags of all mesh vertices in bulk """
+    count = len(mesh.vertices)
+    hide = np.empty(count, dtype=np.bool_)
+    mesh.vertices.foreach_get('hide', hide)
+    select = np.empty(count, dtype=np.bool_)
+    mesh.vertices.foreach_get('select', select)
+    return hide, select
+
+
+def read_vertex_arrays(mesh):
+    """ Reads coordinates, hide and select flags of all mesh vertices in bulk """
+    return (read_vertex_co(mesh), ) + read_vertex_flags(mesh)
+
+
+def write_vertex_selection(mesh, select):
+    """
+    Writes select flags of all mesh vertices in one call
+    and flushes them to edges and faces like vertex select mode
+    """
+    mesh.vertices.foreach_set('select', select)
+    edges = np.empty(len(mesh.edges) * 2, dtype=np.int32)
+    mesh.edges.foreach_get('vertices', edges)
+    mesh.edges.foreach_set('select', select[edges].reshape((-1, 2)).all(axis=1))
+    if not len(mesh.polygons):
+        return
+    loops = np.empty(len(mesh.loops), dtype=np.int32)
+    mesh.loops.foreach_get('vertex_index', loops)
+    starts = np.empty(len(mesh.polygons), dtype=np.int32)
+    mesh.polygons.foreach_get('loop_start', starts)
+    mesh.polygons.foreach_set('select', np.logical_and.reduceat(select[loops], starts))
+
+
+def count_selected(items):
+    """ Counts selected items of mesh collection (vertices, edges, polygons) """
+    select = np.empty(len(items), dtype=np.bool_)
+    items.foreach_get('select', select)
+    return int(np.count_nonzero(select))
+
+
+def read_object_selection(objects):
+    """ Reads select flags of all objects of collection in bulk """
+    select = np.empty(len(objects), dtype=np.bool_)
+    objects.foreach_get('select', select)
+    return select
+
+
+def read_selected_objects(scene):
+    """
+    List of all scene objects and indices of selected ones, as in context.selected_objects,
+    so objects on hidden layers and hidden objects are not selected.
+    Scene objects of Blender 2.7x are linked list, so it is indexed once
+    """
+    objects = scene.objects
+    select = read_object_selection(objects)
+    hide = np.empty(len(objects), dtype=np.bool_)
+    objects.foreach_get('hide', hide)
+    layers = np.empty(len(objects) * 20, dtype=np.bool_)
+    objects.foreach_get('layers', layers)
+    visible = np.any(layers.reshape((-1, 20)) & np.array(scene.layers[:], dtype=np.bool_), axis=1)
+    return objects[:], np.flatnonzero(select & visible & ~hide)
+
+
+def read_object_array(objects, attr, size):
+    """ Reads float vector attribute of all objects of collection in bulk, one object per row """
+    array = np.empty(len(objects) * size, dtype=np.float32)
+    objects.foreach_get(attr, array)
+    return array.reshape((len(objects), size)).astype(np.float64)
+
+
+def read_object_locations(objects):
+    """ Reads locations of all objects of collection in bulk """
+    return read_object_array(objects, 'location', 3)
+
+
+def write_object_locations(objects, location):
+    """ Writes locations of all objects of collection in one call """
+    objects.foreach_set('location', location.astype(np.float32).ravel())
+
+
+_fingerprints = mesh_cache()
+
+
+def read_array(items, attr, dtype, size=1):
+    """ Reads attribute of all items of collection in bulk """
+    array = np.empty(len(items) * size, dtype=dtype)
+    items.foreach_get(attr, array)
+    return array
+
+
+def get_mesh_fingerprint(mesh, precision=None):
+    """
+    Hash of mesh vertices, edges with their flags, faces, UVs, vertex colors,
+    shape keys, custom normals and materials.
+    Vertex group weights are not hashed, as their groups belong to objects.
+    If precision is given, vertices are rounded to it relative to their lower bound,
+    so copies moved in local space have the same hash.
+    Returns hash and lower bound of vertices. Result is cached until mesh is changed
+    """
+    key = mesh.as_pointer()
+    # Shape key values are stored out of mesh and do not update it
+    key_blocks = mesh.shape_keys.key_blocks if mesh.shape_keys else []
+    shape_keys = [(kb.name, kb.relative_key.name, kb.value, kb.mute,
+                   kb.slider_min, kb.slider_max, kb.interpolation, kb.vertex_group)
+                  for kb in key_blocks]
+    # Pointer of removed mesh can be reused, so sizes are checked too
+    state = (get_mesh_version(mesh), precision, mesh.name,
+             len(mesh.vertices), len(mesh.loops), len(mesh.polygons), shape_keys)
+    cached = _fingerprints.get(key)
+    if cached is not None and cached[0] == state:
+        return cached[1:]
+    co = read_array(mesh.vertices, 'co', np.float32, 3).reshape((-1, 3))
+    lower = co.min(axis=0).astype(np.float64) if len(co) else np.zeros(3)
+
+    def round_co(array):
+        if precision is None:
+            return array
+        return np.round((array.reshape((-1, 3)) - lower) / precision).astype(np.int64)
+
+    arrays = [round_co(co),
+              read_array(mesh.edges, 'vertices', np.int32, 2),
+              read_array(mesh.edges, 'crease', np.float32),
+              read_array(mesh.edges, 'bevel_weight', np.float32),
+              read_array(mesh.edges, 'use_seam', np.bool_),
+              read_array(mesh.edges, 'use_edge_sharp', np.bool_),
+              read_array(mesh.loops, 'vertex_index', np.int32),
+              read_array(mesh.polygons, 'loop_total', np.int32),
+              read_array(mesh.polygons, 'material_index', np.int32),
+              read_array(mesh.polygons, 'use_smooth', np.bool_)]
+    arrays.extend(read_array(layer.data, 'uv', np.float32, 2) for layer in mesh.uv_layers)
+    arrays.extend(read_array(layer.data, 'color', np.float32, 3) for layer in mesh.vertex_colors)
+    arrays.extend(round_co(read_array(kb.data, 'co', np.float32, 3)) for kb in key_blocks)
+    if mesh.has_custom_normals:
+        # Split normals are not stored in loops until they are calculated
+        mesh.calc_normals_split()
+        arrays.append(read_array(mesh.loops, 'normal', np.float32, 3))
+        mesh.free_normals_split()
+    digest = hashlib.sha1()
+    digest.update(repr([m.name if m else None for m in mesh.materials]).encode('utf-8'))
+    digest.update(repr([layer.name for layer in mesh.uv_layers]).encode('utf-8'))
+    digest.update(repr([layer.name for layer in mesh.vertex_colors]).encode('utf-8'))
+    digest.update(repr((shape_keys, mesh.use_auto_smooth, mesh.auto_smooth_angle)).encode('utf-8'))
+    for array in arrays:
+        digest.update(np.ascontiguousarray(array).tobytes())
+        # Arrays of different length must not join to the same bytes
+        digest.update(str(len(array)).encode())
+    _fingerprints[key] = (state, digest.hexdigest(), lower)
+    return digest.hexdigest(), lower
+
+
+def forget_pointer(pointer):
+    """ Drops version and cached values of mesh by pointer """
+    _mesh_versions.pop(pointer, None)
+    for cache in _caches:
+        cache.pop(pointer, None)
+
+
+def forget_mesh(mesh):
+    """ Drops cached values of mesh, that is going to be removed """
+    forget_pointer(mesh.as_pointer())
+
+
+def estimate_mesh_size(mesh):
+    """ Approximate memory of mesh arrays in bytes, as Blender stores them """
+    return (len(mesh.vertices) * 20 + len(mesh.edges) * 12 + len(mesh.polygons) * 12 +
+            len(mesh.loops) * (8 + 8 * len(mesh.uv_layers)))
+
+
+def get_edit_objects(context):
+    """ Mesh objects in edit mode. Blender 2.7x edits only one object """
+    return [context.edit_object]
+
+
+def to_world(co, matrix_world):
+    """ Transforms array of local coordinates to world space """
+    matrix = np.array(matrix_world, dtype=np.float64)
+    return np.dot(co, matrix[:3, :3].T) + matrix[:3, 3]
+
+
+def to_local(co, matrix_world):
+    """ Transforms array of world coordinates to local space of object """
+    matrix = np.linalg.inv(np.array(matrix_world, dtype=np.float64))
+    return np.dot(co, matrix[:3, :3].T) + matrix[:3, 3]
+
+
+def sync_edit_meshes(objects):
+    """
+    Writes edit meshes of objects to their mesh data without leaving edit mode,
+    then read_edit_* functions read mesh data in bulk. Must be called before them.
+    Loading does not change geometry, so it does not change versions of meshes
+    """
+    for obj in objects:
+        if hasattr(obj, 'update_from_editmode'):
+            obj.update_from_editmode()
+            _quiet_updates.add(obj.data.as_pointer())
+
+
+def read_edit_vertex_co(obj):
+    """ Reads coordinates of all vertices of object in edit mode """
+    if hasattr(obj, 'update_from_editmode'):
+        return read_vertex_co(obj.data)
+    verts = bmesh.from_edit_mesh(obj.data).verts
+    co = np.fromiter(itertools.chain.from_iterable(v.co for v in verts),
+                     dtype=np.float64, count=len(verts) * 3)
+    return co.reshape((len(verts), 3))
+
+
+def read_edit_vertex_flags(obj):
+    """ Reads hide and select flags of all vertices of object in edit mode """
+    if hasattr(obj, 'update_from_editmode'):
+        return read_vertex_flags(obj.data)
+    verts = bmesh.from_edit_mesh(obj.data).verts
+    hide = np.fromiter((v.hide for v in verts), dtype=np.bool_, count=len(verts))
+    select = np.fromiter((v.select for v in verts), dtype=np.bool_, count=len(verts))
+    return hide, select
+
+
+def count_edit_selected(obj):
+    """ Counts selected edges and faces of object in edit mode """
+    if hasattr(obj, 'update_from_editmode'):
+        return count_selected(obj.data.edges), count_selected(obj.data.polygons)
+    bm = bmesh.from_edit_mesh(obj.data)
+    return (sum(1 for e in bm.edges if e.select),
+            sum(1 for f in bm.faces if f.select))
+
+
+def select_edit_vertices(obj, mask):
+    """ Selects vertices of object in edit mode by mask. Others stay as they are """
+    verts = bmesh.from_edit_mesh(obj.data).verts
+    verts.ensure_lookup_table()
+    for index in np.flatnonzero(mask):
+        verts[index].select = True
+
+
+def write_edit_vertex_co(obj, indices, co):
+    """ Sets coordinates of vertices with indices of object in edit mode """
+    verts = bmesh.from_edit_mesh(obj.data).verts
+    verts.ensure_lookup_table()
+    for index, vert_co in zip(indices.tolist(), co.tolist()):
+        verts[index].co = vert_co
+
+
+def write_edit_vertex_selection(obj, select, current):
+    """ Sets select flags of vertices of object in edit mode, where select differs from current """
+    verts = bmesh.from_edit_mesh(obj.data).verts
+    verts.ensure_lookup_table()
+    for index in np.flatnonzero(current != select):
+        verts[index].select = bool(select[index])
+
+
+def refresh_edit_meshes(context, objects, flush_vertices=False, geometry_changed=True):
+    """
+    Shows changes of edit meshes in viewport without leaving edit mode.
+    If flush_vertices, selection of vertices is flushed to edges and faces
+    like in vertex select mode, and then previous select mode is restored.
+    If not geometry_changed, the update does not change versions of meshes
+    """
+    for obj in objects:
+        if geometry_changed:
+            # Mesh could be loaded by sync_edit_meshes before
+            _quiet_updates.discard(obj.data.as_pointer())
+        else:
+            _quiet_updates.add(obj.data.as_pointer())
+        bmesh.update_edit_mesh(obj.data)
+    if flush_vertices:
+        select_mode = context.tool_settings.mesh_select_mode[:]
+        bpy.ops.mesh.select_mode(type='VERT')
+        context.tool_settings.mesh_select_mode = select_mode
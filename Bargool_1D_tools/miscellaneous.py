@@ -1,6 +1,8 @@
 import bmesh
 import bpy
 
+from .mesh_utils import refresh_edit_meshes
+
 __author__ = 'Aleksey Nakoryakov'
 
 
@@ -99,6 +101,7 @@ class MeshSingleVertexOperator(bpy.types.Operator):
         bpy.ops.mesh.select_all(action='DESELECT')
         if selected_verts:
             selected_verts[0].select = True
+        refresh_edit_meshes(context, [obj], geometry_changed=False)
         return {'FINISHED'}
 
 
@@ -1,6 +1,6 @@
 import bpy
 
-from . import naming, import_utils, miscellaneous, geometry, instances, removers
+from . import naming, import_utils, miscellaneous, geometry, instances, removers, selectors
 
 __author__ = 'Aleksey Nakoryakov'
 
@@ -47,6 +47,8 @@ class BatchSetPanel(bpy.types.Panel):
                      text='Options')
             col.prop(scene.batch_operator_settings,
                      'select_global_limit')
+            col = box.column(align=True)
+            selectors.create_panel(col, scene)
 
         # Batch remover
         if self.do_create_subpanel(top_col, 'do_show_remover', 'Batch Remover'):
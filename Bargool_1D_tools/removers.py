@@ -342,3 +342,4 @@ def create_panel(col, scene):
     col.prop(scene.batch_operator_settings, 'removers_dropdown',
              text='Action')
     col.prop(scene.batch_operator_settings, 'work_without_selection')
+    col.prop(scene.batch_operator_settings, 'batch_modal')
@@ -1,10 +1,237 @@
-from collections import namedtuple
+import bisect
+import math
+from collections import namedtuple, defaultdict
 
 import bmesh
 import bpy
 
+from .mesh_utils import (np, get_edit_objects, to_world, get_mesh_version, mesh_cache,
+                         sync_edit_meshes, read_edit_vertex_co, read_edit_vertex_flags,
+                         count_edit_selected, select_edit_vertices, refresh_edit_meshes,
+                         read_vertex_flags, write_vertex_selection, write_edit_vertex_selection)
+
 __author__ = 'Aleksey Nakoryakov'
 
+# Column of selected vertices with same XY. zs - list of zeds =)
+Vertex = namedtuple('Vertex', ['x', 'y', 'zs', 'zmin', 'zmax'])
+# Array-backed columns. Each field is array, zs - all selected zeds
+Columns = namedtuple('Columns', ['x', 'y', 'zs', 'zmin', 'zmax'])
+
+
+class ColumnsIndex(object):
+    """
+    Grid hash of selected columns by XY.
+    Cell size is a little bit bigger than threshold, so every column
+    closer than threshold to a point lies in the point's cell or in one
+    of its 8 neighbours, even with float rounding of cell numbers
+    """
+    def __init__(self, columns, threshold):
+        self.threshold = threshold
+        self.cell_size = threshold * (1 + 1e-6)
+        self.cells = defaultdict(list)
+        if threshold <= 0:
+            # Nothing could be closer than zero threshold
+            return
+        for column in columns:
+            self.cells[self.get_cell(column.x, column.y)].append(column)
+
+    def get_cell(self, x, y):
+        return (int(math.floor(x / self.cell_size)),
+                int(math.floor(y / self.cell_size)))
+
+    def find(self, x, y):
+        """ Yields columns closer than threshold to point x, y """
+        if not self.cells:
+            return
+        threshold = self.threshold
+        cx, cy = self.get_cell(x, y)
+        for i in (cx - 1, cx, cx + 1):
+            for j in (cy - 1, cy, cy + 1):
+                for v in self.cells.get((i, j), ()):
+                    if abs(x - v.x) < threshold and abs(y - v.y) < threshold:
+                        yield v
+
+
+class LevelsIndex(object):
+    """
+    Selected Z levels as sorted disjoint intervals.
+    Open intervals (z - threshold, z + threshold) of all levels are merged,
+    so a point is checked with bisection instead of scan of all levels
+    """
+    def __init__(self, zs, threshold):
+        self.lowers = []
+        self.uppers = []
+        if threshold <= 0:
+            return
+        for z in sorted(set(zs)):
+            lower, upper = z - threshold, z + threshold
+            if self.uppers and lower < self.uppers[-1]:
+                self.uppers[-1] = max(self.uppers[-1], upper)
+            else:
+                self.lowers.append(lower)
+                self.uppers.append(upper)
+
+    def contains(self, z):
+        # Only interval with greatest lower bound less than z could contain z
+        index = bisect.bisect_left(self.lowers, z) - 1
+        return index >= 0 and z < self.uppers[index]
+
+
+def get_levels_mask(z, zs, threshold):
+    """ Vectorized LevelsIndex.contains for array of zeds """
+    if threshold <= 0:
+        return np.zeros(len(z), dtype=np.bool_)
+    levels = np.unique(zs)
+    lowers, uppers = levels - threshold, levels + threshold
+    # Interval starts where it does not overlap previous one.
+    # Bounds grow with levels, so merged upper bound is the last one
+    starts = np.flatnonzero(np.r_[True, lowers[1:] >= uppers[:-1]])
+    ends = np.r_[starts[1:] - 1, len(levels) - 1]
+    lowers, uppers = lowers[starts], uppers[ends]
+    index = np.searchsorted(lowers, z, side='left') - 1
+    mask = index >= 0
+    mask[mask] = z[mask] < uppers[index[mask]]
+    return mask
+
+
+def get_selected_columns(co, select, global_limit):
+    """ Array analog of get_selected_verts. Groups selected vertices by XY """
+    selected = co[select]
+    if not len(selected):
+        return None
+    selected = selected[np.lexsort((selected[:, 1], selected[:, 0]))]
+    xy = selected[:, :2]
+    starts = np.flatnonzero(np.r_[True, np.any(xy[1:] != xy[:-1], axis=1)])
+    zs = selected[:, 2]
+    zmin = np.minimum.reduceat(zs, starts)
+    zmax = np.maximum.reduceat(zs, starts)
+    if global_limit:
+        zmin[:] = zmin.min()
+        zmax[:] = zmax.max()
+    return Columns(x=xy[starts, 0], y=xy[starts, 1], zs=zs, zmin=zmin, zmax=zmax)
+
+
+class VertexGrid(object):
+    """
+    Vertices of mesh in world space hashed to XY cells like in ColumnsIndex,
+    with Z range of each cell. It depends only on geometry and threshold,
+    so it is cached and reused by repeated selections
+    """
+    def __init__(self, co, threshold, matrix, version):
+        self.co = co
+        self.threshold = threshold
+        self.matrix = matrix
+        self.version = version
+        self.cell_size = threshold * (1 + 1e-6)
+        self.cell_keys = np.empty(0, dtype=np.int64)
+        if threshold <= 0 or not len(co):
+            return
+        cx, cy = self.get_cells(co[:, 0], co[:, 1])
+        self.xmin, self.xmax = cx.min(), cx.max()
+        self.ymin, self.ymax = cy.min(), cy.max()
+        self.width = self.ymax - self.ymin + 1
+        keys = (cx - self.xmin) * self.width + (cy - self.ymin)
+        self.order = np.argsort(keys, kind='mergesort')
+        keys = keys[self.order]
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+        self.cell_keys = keys[starts]
+        self.cell_starts = starts
+        self.cell_counts = np.diff(np.r_[starts, len(keys)])
+        z = co[self.order, 2]
+        self.cell_zmin = np.minimum.reduceat(z, starts)
+        self.cell_zmax = np.maximum.reduceat(z, starts)
+
+    def get_cells(self, x, y):
+        return (np.floor(x / self.cell_size).astype(np.int64),
+                np.floor(y / self.cell_size).astype(np.int64))
+
+    def find_cells(self, columns):
+        """ Yields pairs of arrays (column indices, cell indices) of neighbour cells """
+        if not len(self.cell_keys):
+            return
+        ccx, ccy = self.get_cells(columns.x, columns.y)
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                cx, cy = ccx + dx, ccy + dy
+                inside = np.flatnonzero((cx >= self.xmin) & (cx <= self.xmax) &
+                                        (cy >= self.ymin) & (cy <= self.ymax))
+                keys = (cx[inside] - self.xmin) * self.width + (cy[inside] - self.ymin)
+                cells = np.searchsorted(self.cell_keys, keys)
+                found = cells < len(self.cell_keys)
+                found[found] = self.cell_keys[cells[found]] == keys[found]
+                yield inside[found], cells[found]
+
+    def match_columns(self, columns, behaviour):
+        """ Yields pairs of arrays (vertex indices, column indices) fitting behaviour """
+        threshold = self.threshold
+        x, y, z = self.co[:, 0], self.co[:, 1], self.co[:, 2]
+        for c_idx, cells in self.find_cells(columns):
+            # Skip cells that are out of Z limits of columns
+            fit = np.ones(len(cells), dtype=np.bool_)
+            if behaviour in ('Z Up', 'Z Between'):
+                fit &= columns.zmin[c_idx] - self.cell_zmax[cells] < threshold
+            if behaviour in ('Z Down', 'Z Between'):
+                fit &= self.cell_zmin[cells] - columns.zmax[c_idx] < threshold
+            c_idx, cells = c_idx[fit], cells[fit]
+            # Expand pairs of column and cell to pairs of column and vertex
+            counts = self.cell_counts[cells]
+            offsets = np.cumsum(counts) - counts
+            steps = np.arange(counts.sum()) - np.repeat(offsets, counts)
+            v_idx = self.order[np.repeat(self.cell_starts[cells], counts) + steps]
+            c_idx = np.repeat(c_idx, counts)
+
+            fit = ((np.abs(x[v_idx] - columns.x[c_idx]) < threshold) &
+                   (np.abs(y[v_idx] - columns.y[c_idx]) < threshold))
+            if behaviour in ('Z Up', 'Z Between'):
+                fit &= columns.zmin[c_idx] - z[v_idx] < threshold
+            if behaviour in ('Z Down', 'Z Between'):
+                fit &= z[v_idx] - columns.zmax[c_idx] < threshold
+            yield v_idx[fit], c_idx[fit]
+
+
+# Last VertexGrid of mesh by pointer
+_grids = mesh_cache()
+
+
+def get_vertex_grid(obj, threshold):
+    """ Cached VertexGrid of object mesh in edit mode """
+    mesh = obj.data
+    matrix = tuple(tuple(row) for row in obj.matrix_world)
+    version = get_mesh_version(mesh)
+    key = mesh.as_pointer()
+    grid = _grids.get(key)
+    if grid is not None and grid.threshold != threshold:
+        grid = None
+    # Vertices of mesh data are not updated in edit mode, so count them in BMesh
+    if (grid is not None and grid.matrix == matrix and grid.version == version and
+            len(grid.co) == len(bmesh.from_edit_mesh(mesh).verts)):
+        return grid
+    co = to_world(read_edit_vertex_co(obj), matrix)
+    if grid is not None and grid.matrix == matrix and np.array_equal(grid.co, co):
+        # Update was not about our vertices
+        grid.version = version
+        return grid
+    grid = _grids[key] = VertexGrid(co, threshold, matrix, version)
+    return grid
+
+
+def get_fitness_mask(grid, columns, behaviour, global_limit):
+    """ Vectorized fitness_func of VerticalVerticesSelectOperator for all vertices of grid """
+    threshold = grid.threshold
+    z = grid.co[:, 2]
+    if behaviour == 'Z Level':
+        if global_limit:
+            zmin, zmax = columns.zmin.min(), columns.zmax.max()
+            return (z - zmax < threshold) & (zmin - z < threshold)
+        return get_levels_mask(z, columns.zs, threshold)
+
+    if behaviour not in ('Z All', 'Z Up', 'Z Down', 'Z Between'):
+        raise ValueError('Undefined behaviour: {}'.format(behaviour))
+    mask = np.zeros(len(z), dtype=np.bool_)
+    for v_idx, _ in grid.match_columns(columns, behaviour):
+        mask[v_idx] = True
+    return mask
+
 
 class VerticalVerticesSelectOperator(bpy.types.Operator):
     bl_idname = 'mesh.select_vertices'
@@ -16,11 +243,9 @@ class VerticalVerticesSelectOperator(bpy.types.Operator):
         return context.mode == 'EDIT_MESH'
 
     @classmethod
-    def get_selected_verts(cls, context, bm=None):
-        if not bm:
-            obj = context.active_object
-            bm = bmesh.from_edit_mesh(obj.data)
-        selected = [(v.co.x, v.co.y, v.co.z) for v in bm.verts if v.select]
+    def get_selected_verts(cls, context, points):
+        """ Groups selected vertices to columns. points - pairs of BMVert and its world coordinates """
+        selected = [co for v, co in points if v.select]
         if not selected:
             return None
         seldict = {}
@@ -29,7 +254,6 @@ class VerticalVerticesSelectOperator(bpy.types.Operator):
                 seldict[(x, y)].append(z)
             else:
                 seldict[(x, y)] = [z, ]
-        Vertex = namedtuple('Vertex', ['x', 'y', 'zs', 'zmin', 'zmax'])  # zs - list of zeds =)
         result_coords = [
             Vertex(x=xy[0], y=xy[1], zs=z, zmin=min(z), zmax=max(z))
             for xy, z in seldict.items()]
@@ -43,85 +267,260 @@ class VerticalVerticesSelectOperator(bpy.types.Operator):
         return result_coords
 
     def execute(self, context):
-        threshold = context.scene.tool_settings.double_threshold
-        obj = context.active_object
-        bm = bmesh.from_edit_mesh(obj.data)
-        selected = self.get_selected_verts(bm=bm, context=context)
-        if not selected:
+        objects = get_edit_objects(context)
+        if np is None:
+            count = self.select_bmesh(context, objects)
+        else:
+            count = self.select_arrays(context, objects)
+        if count is None:
             self.report({'INFO'}, 'Must select vertices previously')
             return {'CANCELLED'}
+        # Force blender show selected vertices
+        refresh_edit_meshes(context, objects, flush_vertices=True, geometry_changed=False)
+        message = 'Selected {0} vertices'.format(count)
+        self.report({'INFO'}, message)
+
+        return {'FINISHED'}
+
+    @staticmethod
+    def get_behaviour(context, edges_count, faces_count):
+        behaviour = context.scene.batch_operator_settings.verticals_select_behaviour
+        if behaviour == 'Z Between' and (faces_count == 1 or edges_count == 1):
+            behaviour = 'Z All'
+        return behaviour
+
+    def select_arrays(self, context, objects):
+        """ Vectorized selection. Returns count of fitting vertices """
+        threshold = context.scene.tool_settings.double_threshold
+        global_limit = context.scene.batch_operator_settings.select_global_limit
+        sync_edit_meshes(objects)
+        # Columns go through all objects, so work in world space
+        grids = [get_vertex_grid(obj, threshold) for obj in objects]
+        flags = [read_edit_vertex_flags(obj) for obj in objects]
+        co = np.concatenate([grid.co for grid in grids])
+        select = np.concatenate([f[1] for f in flags])
+        columns = get_selected_columns(co, select, global_limit)
+        if columns is None:
+            return None
+        edges_count = 0
+        faces_count = 0
+        if context.scene.batch_operator_settings.verticals_select_behaviour == 'Z Between':
+            # Counting reads all edges and faces, so only when it matters
+            for obj in objects:
+                edges, faces = count_edit_selected(obj)
+                edges_count += edges
+                faces_count += faces
+        behaviour = self.get_behaviour(context, edges_count, faces_count)
         count = 0
+        for obj, grid, (hide, select) in zip(objects, grids, flags):
+            fitting = get_fitness_mask(grid, columns, behaviour, global_limit) & ~hide
+            count += int(np.count_nonzero(fitting))
+            select_edit_vertices(obj, fitting & ~select)
+        return count
 
-        settings = context.scene.batch_operator_settings
-        behaviour = settings.verticals_select_behaviour
-
-        if behaviour == 'Z Between':
-            edges_count = 0
-            for e in bm.edges:
-                if e.select:
-                    edges_count += 1
-            faces_count = 0
-            for f in bm.faces:
-                if f.select:
-                    faces_count += 1
-            if faces_count == 1 or edges_count == 1:
-                behaviour = 'Z All'
+    def select_bmesh(self, context, objects):
+        """ Per-vertex selection. Returns count of fitting vertices """
+        threshold = context.scene.tool_settings.double_threshold
+        bms = [(obj.matrix_world, bmesh.from_edit_mesh(obj.data)) for obj in objects]
+        # Columns go through all objects, so work in world space
+        points = [(v, (matrix_world * v.co).to_tuple())
+                  for matrix_world, bm in bms for v in bm.verts]
+        selected = self.get_selected_verts(context, points)
+        if not selected:
+            return None
+        count = 0
 
+        edges_count = 0
+        faces_count = 0
+        if context.scene.batch_operator_settings.verticals_select_behaviour == 'Z Between':
+            for _, bm in bms:
+                for e in bm.edges:
+                    if e.select:
+                        edges_count += 1
+                for f in bm.faces:
+                    if f.select:
+                        faces_count += 1
+        behaviour = self.get_behaviour(context, edges_count, faces_count)
+        columns = ColumnsIndex(selected, threshold)
         if behaviour == 'Z All':
-            fitness_func = lambda vert: [
-                v for v in selected
-                if (abs(vert.co.x - v.x) < threshold
-                    and abs(vert.co.y - v.y) < threshold)]
+            fitness_func = lambda co: any(
+                columns.find(co[0], co[1]))
         elif behaviour == 'Z Up':
-            fitness_func = lambda vert: [
-                v for v in selected
-                if (abs(vert.co.x - v.x) < threshold
-                    and abs(vert.co.y - v.y) < threshold
-                    and v.zmin - vert.co.z < threshold)]
+            fitness_func = lambda co: any(
+                v.zmin - co[2] < threshold
+                for v in columns.find(co[0], co[1]))
         elif behaviour == 'Z Down':
-            fitness_func = lambda vert: [
-                v for v in selected
-                if (abs(vert.co.x - v.x) < threshold
-                    and abs(vert.co.y - v.y) < threshold
-                    and vert.co.z - v.zmax < threshold)]
+            fitness_func = lambda co: any(
+                co[2] - v.zmax < threshold
+                for v in columns.find(co[0], co[1]))
         elif behaviour == 'Z Between':
-            fitness_func = lambda vert: [
-                v for v in selected
-                if (abs(vert.co.x - v.x) < threshold
-                    and abs(vert.co.y - v.y) < threshold
-                    and vert.co.z - v.zmax < threshold
-                    and v.zmin - vert.co.z < threshold)]
+            fitness_func = lambda co: any(
+                co[2] - v.zmax < threshold and v.zmin - co[2] < threshold
+                for v in columns.find(co[0], co[1]))
         elif behaviour == 'Z Level':
             global_limit = context.scene.batch_operator_settings.select_global_limit
 
             if global_limit:
                 zmin, zmax = min(x.zmin for x in selected), max(
                     x.zmax for x in selected)
-                fitness_func = lambda vert: [
-                    v for v in selected
-                    if (vert.co.z - zmax < threshold
-                        and zmin - vert.co.z < threshold)]
+                fitness_func = lambda co: (co[2] - zmax < threshold
+                                           and zmin - co[2] < threshold)
             else:
-                selected_z = frozenset([z for v in selected for z in v.zs])
-                fitness_func = lambda vert: [
-                    z for z in selected_z
-                    if z - threshold < vert.co.z < z + threshold]
+                levels = LevelsIndex([z for v in selected for z in v.zs], threshold)
+                fitness_func = lambda co: levels.contains(co[2])
         else:
             raise ValueError('Undefined behaviour: {}'.format(behaviour))
 
-        for vert in bm.verts:
-            if not vert.hide and fitness_func(vert):
+        for vert, co in points:
+            if not vert.hide and fitness_func(co):
                 count += 1
                 vert.select = True
-        # Remember previous selection mode. We will restore it later
-        select_mode = context.tool_settings.mesh_select_mode[:]
-        # Force blender show selected vertices
-        bpy.ops.object.mode_set(mode='OBJECT')
-        bpy.ops.object.mode_set(mode='EDIT')
-        bpy.ops.mesh.select_mode(type='VERT')
-        # Return to previous select_mode
-        context.tool_settings.mesh_select_mode = select_mode
-        message = 'Selected {0} vertices'.format(count)
-        self.report({'INFO'}, message)
+        return count
+
+
+def pack_selection(select):
+    """ Packs selection mask to bitset as int32 array, so it could be stored in ID property """
+    bits = np.packbits(select)
+    bits = np.r_[bits, np.zeros(-len(bits) % 4, dtype=np.uint8)]
+    return bits.view(np.int32)
+
+
+def unpack_selection(bitset, count):
+    """ Unpacks bitset made by pack_selection to selection mask of count vertices """
+    bits = np.asarray(bitset, dtype=np.int32).view(np.uint8)
+    return np.unpackbits(bits)[:count].astype(np.bool_)
 
+
+class VertexSelectionMixin(object):
+    """ Base for operators working with named vertex selections stored on meshes """
+    bl_options = {'REGISTER', 'UNDO'}
+
+    # ID property of mesh with stored selections
+    selections_key = 'vertex_selections'
+
+    @classmethod
+    def poll(cls, context):
+        return np is not None and context.mode in ('EDIT_MESH', 'OBJECT')
+
+    def get_objects(self, context):
+        if context.mode == 'EDIT_MESH':
+            return get_edit_objects(context)
+        return [o for o in context.selected_objects if o.type == 'MESH']
+
+    def read_flags(self, context, obj):
+        """ Hide and select flags of vertices """
+        if context.mode == 'EDIT_MESH':
+            return read_edit_vertex_flags(obj)
+        return read_vertex_flags(obj.data)
+
+    def execute(self, context):
+        self.name = context.scene.batch_operator_settings.vertex_selection_name
+        objects = self.get_objects(context)
+        if context.mode == 'EDIT_MESH':
+            sync_edit_meshes(objects)
+        count = 0
+        for obj in objects:
+            count += self.process_mesh(context, obj)
+        if context.mode == 'EDIT_MESH':
+            refresh_edit_meshes(context, objects, flush_vertices=True, geometry_changed=False)
+        self.post_process(count)
         return {'FINISHED'}
+
+    def process_mesh(self, context, obj):
+        raise NotImplementedError
+
+    def post_process(self, count):
+        pass
+
+
+class StoreVertexSelectionOperator(VertexSelectionMixin, bpy.types.Operator):
+    bl_idname = 'mesh.store_vertex_selection'
+    bl_label = 'Store selection'
+    bl_description = 'Stores selected vertices of meshes with name'
+
+    def process_mesh(self, context, obj):
+        _, select = self.read_flags(context, obj)
+        mesh = obj.data
+        if self.selections_key not in mesh:
+            mesh[self.selections_key] = {}
+        mesh[self.selections_key][self.name] = {
+            'count': len(select),
+            'bitset': pack_selection(select).tolist(),
+        }
+        return 1
+
+    def post_process(self, count):
+        self.report({'INFO'}, 'Stored "{}" in {} meshes'.format(self.name, count))
+
+
+class RestoreVertexSelectionOperator(VertexSelectionMixin, bpy.types.Operator):
+    bl_idname = 'mesh.restore_vertex_selection'
+    bl_label = 'Restore selection'
+    bl_description = 'Restores or combines with current stored selection of vertices'
+
+    class OPERATOR_TYPE_ENUM:
+        do_set = 'DO_SET'
+        do_union = 'DO_UNION'
+        do_intersect = 'DO_INTERSECT'
+        do_difference = 'DO_DIFFERENCE'
+
+    operator_type = bpy.props.EnumProperty(items=((OPERATOR_TYPE_ENUM.do_set,) * 3,
+                                                  (OPERATOR_TYPE_ENUM.do_union,) * 3,
+                                                  (OPERATOR_TYPE_ENUM.do_intersect,) * 3,
+                                                  (OPERATOR_TYPE_ENUM.do_difference,) * 3),
+                                           options={'HIDDEN'})
+
+    def combine(self, current, stored):
+        if self.operator_type == self.OPERATOR_TYPE_ENUM.do_union:
+            return current | stored
+        elif self.operator_type == self.OPERATOR_TYPE_ENUM.do_intersect:
+            return current & stored
+        elif self.operator_type == self.OPERATOR_TYPE_ENUM.do_difference:
+            return current & ~stored
+        return stored
+
+    def execute(self, context):
+        self.skipped = 0
+        self.changed = 0
+        return super(RestoreVertexSelectionOperator, self).execute(context)
+
+    def process_mesh(self, context, obj):
+        mesh = obj.data
+        stored = mesh.get(self.selections_key, {}).get(self.name)
+        if stored is None:
+            self.skipped += 1
+            return 0
+        # Flags are read after edit mesh is loaded, as mesh.vertices are stale in edit mode
+        hide, current = self.read_flags(context, obj)
+        if stored['count'] != len(current):
+            # Geometry was changed since
+            self.changed += 1
+            return 0
+        select = self.combine(current, unpack_selection(stored['bitset'].to_list(), stored['count']))
+        # Hidden vertices could not be selected
+        select &= ~hide
+        if context.mode == 'EDIT_MESH':
+            write_edit_vertex_selection(obj, select, current)
+        else:
+            write_vertex_selection(mesh, select)
+        return int(np.count_nonzero(select))
+
+    def post_process(self, count):
+        message = 'Selected {} vertices'.format(count)
+        if self.skipped:
+            message += ', skipped {} meshes without "{}"'.format(self.skipped, self.name)
+        if self.changed:
+            message += ', skipped {} meshes with changed vertices'.format(self.changed)
+        self.report({'INFO'}, message)
+
+
+def create_panel(col, scene):
+    col.prop(scene.batch_operator_settings, 'vertex_selection_name')
+    col.operator(StoreVertexSelectionOperator.bl_idname)
+    enum = RestoreVertexSelectionOperator.OPERATOR_TYPE_ENUM
+    for operator_type, text in ((enum.do_set, 'Restore selection'),
+                                (enum.do_union, 'Add stored'),
+                                (enum.do_intersect, 'Intersect stored'),
+                                (enum.do_difference, 'Subtract stored')):
+        col.operator(RestoreVertexSelectionOperator.bl_idname,
+                     text=text).operator_type = operator_type
@@ -19,6 +19,12 @@ class BatchOperatorSettings(bpy.types.PropertyGroup):
         description='If set, batch erasers will '
                     'work with all objects without selection')
 
+    batch_modal = bpy.props.BoolProperty(
+        name='Modal',
+        default=False,
+        description='If set, batch operators process objects in chunks by timer, '
+                    'show progress and can be cancelled with Esc')
+
     # We need all subclasses of BatchRemoverMixin in one dropdown
     operators = [
         (op.bl_idname, op.dropdown_name, get_description(op))
@@ -42,6 +48,9 @@ class BatchOperatorSettings(bpy.types.PropertyGroup):
     select_global_limit = bpy.props.BoolProperty(name='Global limit',
                                                  default=True)
 
+    vertex_selection_name = bpy.props.StringProperty(name='Selection',
+                                                     default='Selection')
+
     import_cleanup_recalculate_normals = bpy.props.BoolProperty(
         name='Recalculate Normals', default=False)
     import_cleanup_apply_rotations = bpy.props.BoolProperty(
@@ -83,6 +92,7 @@ class BatchOperatorSettings(bpy.types.PropertyGroup):
 class TestSettings:
     text = None
     slope_plane = None
+    surface = None
 
 
 class BatchPanelSettings(bpy.types.PropertyGroup):
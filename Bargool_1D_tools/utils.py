@@ -1,4 +1,5 @@
 import collections
+import time
 from abc import abstractmethod, ABCMeta
 
 import bpy
@@ -62,15 +63,30 @@ class BatchOperatorMixin(object):
 
     use_only_selected_objects = True
     context = None
+    # Seconds of processing per timer event in modal mode
+    modal_time_budget = 0.05
 
     def get_use_selected_objects(self):
         return self.use_only_selected_objects
 
+    def get_use_modal(self):
+        return self.context.scene.batch_operator_settings.batch_modal
+
     def execute(self, context):
         """
         Template method pattern
         Must override filter_object, process_object and pre_process_objects
         """
+        self.prepare_objects(context)
+        # Cache old active object. At the end we will return activeness
+        old_active = bpy.context.scene.objects.active
+        for obj in self.work_objects:
+            self.process_active_object(obj)
+        bpy.context.scene.objects.active = old_active
+        self.post_process_objects()
+        return {'FINISHED'}
+
+    def prepare_objects(self, context):
         self.context = context
         # Select and filter objects
         self.selected_objects = context.selected_objects[:]
@@ -82,16 +98,56 @@ class BatchOperatorMixin(object):
             self.objects = context.scene.objects
         self.pre_filter_objects()
         self.work_objects = [obj for obj in self.objects if self.filter_object(obj)]
-        # Cache old active object. At the end we will return activeness
-        old_active = bpy.context.scene.objects.active
-        for obj in self.work_objects:
-            # As I understood, objects for bpy.ops operators must be
-            # active in most cases
-            bpy.context.scene.objects.active = obj
-            # Fight!
-            self.process_object(obj)
-        bpy.context.scene.objects.active = old_active
+
+    def process_active_object(self, obj):
+        # As I understood, objects for bpy.ops operators must be
+        # active in most cases
+        bpy.context.scene.objects.active = obj
+        # Fight!
+        self.process_object(obj)
+
+    def invoke(self, context, event):
+        """
+        In modal mode work objects are processed by timer in chunks of modal_time_budget,
+        so UI is redrawn, shows progress and can be cancelled with Esc
+        """
+        self.context = context
+        if not self.get_use_modal():
+            return self.execute(context)
+        self.prepare_objects(context)
+        self.old_active = context.scene.objects.active
+        self.processed_count = 0
+        wm = context.window_manager
+        wm.progress_begin(0, len(self.work_objects))
+        self.timer = wm.event_timer_add(0.01, window=context.window)
+        wm.modal_handler_add(self)
+        return {'RUNNING_MODAL'}
+
+    def modal(self, context, event):
+        self.context = context
+        if event.type == 'ESC':
+            self.report({'WARNING'}, 'Cancelled after {} of {} objects'.format(
+                self.processed_count, len(self.work_objects)))
+            return self.finish_modal(context)
+        if event.type != 'TIMER':
+            # Undo, deleting or file loading would free work objects, so all other events are blocked
+            return {'RUNNING_MODAL'}
+        deadline = time.time() + self.modal_time_budget
+        while self.processed_count < len(self.work_objects) and time.time() < deadline:
+            self.process_active_object(self.work_objects[self.processed_count])
+            self.processed_count += 1
+        context.window_manager.progress_update(self.processed_count)
+        if self.processed_count == len(self.work_objects):
+            return self.finish_modal(context)
+        return {'RUNNING_MODAL'}
+
+    def finish_modal(self, context):
+        wm = context.window_manager
+        wm.event_timer_remove(self.timer)
+        wm.progress_end()
+        context.scene.objects.active = self.old_active
         self.post_process_objects()
+        # Cancelled run changed processed objects too, so it is one undo step as finished one
         return {'FINISHED'}
 
     def filter_object(self, obj):
@@ -0,0 +1,88 @@
+"""
+Tests of geometry_utils. Module does not use bpy, so it is loaded by path
+and tests run with plain python -m pytest tests
+"""
+import importlib.util
+import os
+import unittest
+
+try:
+    import numpy as np
+except ImportError:
+    raise unittest.SkipTest('Needs numpy')
+
+__author__ = 'Aleksey Nakoryakov'
+
+
+def load_module(name):
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        'Bargool_1D_tools', name + '.py')
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+geometry_utils = load_module('geometry_utils')
+
+
+def get_hull_area(xy):
+    """ Area of convex hull of points by monotone chain """
+    points = sorted(set(map(tuple, xy.tolist())))
+
+    def half(points):
+        chain = []
+        for p in points:
+            while len(chain) > 1 and ((chain[-1][0] - chain[-2][0]) * (p[1] - chain[-2][1]) -
+                                      (chain[-1][1] - chain[-2][1]) * (p[0] - chain[-2][0])) <= 0:
+                chain.pop()
+            chain.append(p)
+        return chain[:-1]
+
+    hull = half(points) + half(points[::-1])
+    return sum(a[0] * b[1] - b[0] * a[1] for a, b in zip(hull, hull[1:] + hull[:1])) / 2
+
+
+class DelaunayTrianglesTest(unittest.TestCase):
+    def check_triangulation(self, xy):
+        triangles = geometry_utils.delaunay_triangles(xy)
+        # Centered coordinates keep predicates precise far from origin
+        xy = xy - xy.mean(axis=0)
+        a, b, c = (xy[triangles[:, i]] for i in range(3))
+        areas = ((b - a)[:, 0] * (c - a)[:, 1] - (b - a)[:, 1] * (c - a)[:, 0]) / 2
+        self.assertTrue(np.all(areas > 0), 'Triangles must be counterclockwise')
+        self.assertAlmostEqual(areas.sum() / get_hull_area(xy), 1.0, places=9)
+        for triangle in triangles:
+            d = xy[triangle][None, :, :] - xy[:, None, :]
+            squares = (d * d).sum(axis=2)
+            det = (squares[:, 0] * (d[:, 1, 0] * d[:, 2, 1] - d[:, 2, 0] * d[:, 1, 1]) +
+                   squares[:, 1] * (d[:, 2, 0] * d[:, 0, 1] - d[:, 0, 0] * d[:, 2, 1]) +
+                   squares[:, 2] * (d[:, 0, 0] * d[:, 1, 1] - d[:, 1, 0] * d[:, 0, 1]))
+            det[triangle] = 0
+            self.assertFalse(np.any(det > 1e-9 * squares.max() ** 2),
+                             'Circumcircle of {} is not empty'.format(triangle))
+        return triangles
+
+    def test_random_points(self):
+        for seed in range(5):
+            xy = np.random.RandomState(seed).rand(300, 2)
+            triangles = self.check_triangulation(xy)
+            self.assertEqual(set(triangles.ravel().tolist()), set(range(len(xy))))
+
+    def test_points_far_from_origin(self):
+        self.check_triangulation(np.random.RandomState(1).rand(500, 2) + 5e5)
+
+    def test_grid_with_duplicates(self):
+        xy = np.array([(i, j) for i in range(10) for j in range(10)] * 2, dtype=np.float64)
+        triangles = self.check_triangulation(xy)
+        self.assertEqual(len(triangles), 2 * 9 * 9)
+
+    def test_collinear_points(self):
+        xy = np.array([(0, 0), (1, 1), (2, 2), (3, 3)], dtype=np.float64)
+        self.assertEqual(len(geometry_utils.delaunay_triangles(xy)), 0)
+        triangles = self.check_triangulation(np.vstack((xy, [(0, 1)])))
+        self.assertEqual(len(triangles), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
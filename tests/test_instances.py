@@ -0,0 +1,156 @@
+"""
+Tests of placing and syncing instances from text files and of merging meshes. They need Blender, run them with
+blender -b --python tests/test_instances.py
+"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+try:
+    import bpy
+except ImportError:
+    raise unittest.SkipTest('Needs Blender: blender -b --python tests/test_instances.py')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Bargool_1D_tools
+
+__author__ = 'Aleksey Nakoryakov'
+
+
+def setUpModule():
+    Bargool_1D_tools.register()
+
+
+def tearDownModule():
+    Bargool_1D_tools.unregister()
+
+
+class PlaceAndSyncTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.directory, 'instances.txt')
+        self.mesh = bpy.data.meshes.new('sync_mesh')
+        self.mesh.from_pydata([(0, 0, 0), (1, 0, 0), (0, 1, 0)], [], [(0, 1, 2)])
+        self.source = bpy.data.objects.new('sync_source', self.mesh)
+        self.source.location = (-10, -10, 0)
+        bpy.context.scene.objects.link(self.source)
+
+    def tearDown(self):
+        scene = bpy.context.scene
+        for obj in self.get_instances():
+            scene.objects.unlink(obj)
+            bpy.data.objects.remove(obj)
+        bpy.data.meshes.remove(self.mesh)
+        shutil.rmtree(self.directory)
+
+    def write_records(self, locations, scale=(1, 1, 1), rotation=0.5):
+        with open(self.filepath, 'w') as f:
+            for x, y, z in locations:
+                f.write('(sync_mesh {} {} {} {} {} {} {})\n'.format(x, y, z, scale[0], scale[1], scale[2],
+                                                                   rotation))
+
+    def get_instances(self):
+        return [o for o in bpy.context.scene.objects if o.data == self.mesh]
+
+    def get_locations(self):
+        return sorted(tuple(round(v, 4) for v in o.location) for o in self.get_instances()
+                      if o != self.source)
+
+    def check_round_trip(self, use_bulk):
+        self.write_records([(1, 0, 0), (2, 0, 0), (3, 0, 0)])
+        bpy.ops.object.import_instances(filepath=self.filepath, use_bulk=use_bulk, use_parallel=False)
+        self.assertEqual(self.get_locations(), [(1, 0, 0), (2, 0, 0), (3, 0, 0)])
+        # One record is kept, one is moved and one is removed
+        self.write_records([(1, 0, 0), (5, 0, 0)])
+        bpy.ops.object.sync_instances(filepath=self.filepath, use_parallel=False)
+        self.assertEqual(self.get_locations(), [(1, 0, 0), (5, 0, 0)])
+        self.assertIn(self.source, self.get_instances())
+
+    def check_find_after_place(self, use_bulk):
+        # Blender would keep such transform as rotation in (-pi, pi] and other scale
+        self.write_records([(1, 0, 0), (2, 0, 0)], scale=(-1, 1, 1), rotation=4.0)
+        bpy.ops.object.import_instances(filepath=self.filepath, use_bulk=use_bulk, use_parallel=False)
+        for obj in bpy.context.scene.objects:
+            obj.select = False
+        bpy.ops.object.find_instances(filepath=self.filepath, use_parallel=False)
+        self.assertEqual([o.select for o in self.get_instances() if o != self.source], [True, True])
+        self.assertFalse(self.source.select)
+
+    def test_find_after_place(self):
+        self.check_find_after_place(use_bulk=False)
+
+    def test_find_after_bulk_place(self):
+        self.check_find_after_place(use_bulk=True)
+
+    def test_place_in_parallel(self):
+        # Small ranges, so even short file is parsed by worker processes, that must not
+        # import this script with bpy
+        range_size = Bargool_1D_tools.instances.PARALLEL_RANGE_SIZE
+        Bargool_1D_tools.instances.PARALLEL_RANGE_SIZE = 16
+        try:
+            self.write_records([(1, 0, 0), (2, 0, 0), (3, 0, 0)])
+            bpy.ops.object.import_instances(filepath=self.filepath, use_parallel=True)
+        finally:
+            Bargool_1D_tools.instances.PARALLEL_RANGE_SIZE = range_size
+        self.assertEqual(self.get_locations(), [(1, 0, 0), (2, 0, 0), (3, 0, 0)])
+
+    def test_sync_after_place(self):
+        self.check_round_trip(use_bulk=False)
+
+    def test_sync_after_bulk_place(self):
+        self.check_round_trip(use_bulk=True)
+
+
+class MergeIdenticalMeshesTest(unittest.TestCase):
+    def setUp(self):
+        scene = bpy.context.scene
+        for obj in scene.objects:
+            obj.select = False
+        self.objects = []
+        for i in range(2):
+            mesh = bpy.data.meshes.new('merge_mesh')
+            mesh.from_pydata([(0, 0, 0), (1, 0, 0), (0, 1, 0)], [], [(0, 1, 2)])
+            obj = bpy.data.objects.new('merge_object', mesh)
+            scene.objects.link(obj)
+            obj.select = True
+            self.objects.append(obj)
+
+    def tearDown(self):
+        meshes = set(o.data for o in self.objects)
+        for obj in self.objects:
+            bpy.context.scene.objects.unlink(obj)
+            bpy.data.objects.remove(obj)
+        for mesh in meshes:
+            bpy.data.meshes.remove(mesh)
+
+    def get_mesh_count(self):
+        return len(set(o.data for o in self.objects))
+
+    def test_merges_identical(self):
+        bpy.ops.object.merge_identical_meshes()
+        self.assertEqual(self.get_mesh_count(), 1)
+
+    def test_keeps_different_seams(self):
+        self.objects[1].data.edges[0].use_seam = True
+        bpy.ops.object.merge_identical_meshes()
+        self.assertEqual(self.get_mesh_count(), 2)
+
+    def test_keeps_different_shape_keys(self):
+        for obj in self.objects:
+            obj.shape_key_add(name='Basis')
+            obj.shape_key_add(name='Key')
+        self.objects[1].data.shape_keys.key_blocks['Key'].data[0].co = (0, 0, 1)
+        bpy.ops.object.merge_identical_meshes()
+        self.assertEqual(self.get_mesh_count(), 2)
+
+    def test_skips_vertex_groups(self):
+        self.objects[1].vertex_groups.new('Group').add([0], 0.5, 'REPLACE')
+        bpy.ops.object.merge_identical_meshes()
+        self.assertEqual(self.get_mesh_count(), 2)
+
+
+if __name__ == '__main__':
+    unittest.main(argv=[__file__])
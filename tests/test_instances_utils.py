@@ -0,0 +1,154 @@
+"""
+Tests of instances_utils. Module does not use bpy, so it is loaded by path
+and tests run with plain python -m pytest tests
+"""
+import importlib.util
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    import numpy as np
+except ImportError:
+    raise unittest.SkipTest('Needs numpy')
+
+__author__ = 'Aleksey Nakoryakov'
+
+
+def load_module(name):
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        'Bargool_1D_tools', name + '.py')
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+instances_utils = load_module('instances_utils')
+InstanceTable = instances_utils.InstanceTable
+
+
+def make_lines(count, names, seed=0):
+    """ Text records with locations on coarse grid, so some of them are equal """
+    rng = np.random.RandomState(seed)
+    lines = []
+    for i in range(count):
+        location = rng.randint(0, 5, 3) * 0.5
+        scale = rng.choice([1, -1], 3)
+        lines.append('({} {} {} {} {} {} {} {})\n'.format(
+            names[rng.randint(len(names))], location[0], location[1], location[2],
+            scale[0], scale[1], scale[2], rng.randint(0, 3) * 0.25))
+    return lines
+
+
+def get_records(table):
+    """ Records of table as list of (name, values) in table order """
+    return [(table.names[r['mesh']], tuple(r['location']) + tuple(r['scale']) + (float(r['rotation']),))
+            for r in table.records]
+
+
+class InstanceTableTest(unittest.TestCase):
+    def test_from_lines(self):
+        table = InstanceTable.from_lines(['header\n', '(box 1 2 3 1 1 1 0.5)\n',
+                                          '(cone 4 5 6 2 2 2 -1)\r\n', '(box 0 0 0 1 1 1 0)'])
+        self.assertEqual(table.names, ['box', 'cone'])
+        self.assertEqual(get_records(table), [('box', (1, 2, 3, 1, 1, 1, 0.5)),
+                                              ('cone', (4, 5, 6, 2, 2, 2, -1)),
+                                              ('box', (0, 0, 0, 1, 1, 1, 0))])
+
+    def test_from_lines_with_names(self):
+        table = InstanceTable.from_lines(['(box 1 2 3 1 1 1 0.5)\n', '(cone 4 5 6 2 2 2 -1)\n'],
+                                         names={'cone'})
+        self.assertEqual(get_records(table), [('cone', (4, 5, 6, 2, 2, 2, -1))])
+
+    def test_from_lines_checks_numbers(self):
+        with self.assertRaises(ValueError):
+            InstanceTable.from_lines(['(box 1 2 3 1 1 1)\n'])
+
+
+class LocationGridTest(unittest.TestCase):
+    def test_take_as_brute_force(self):
+        tolerance = 0.3
+        table = InstanceTable.from_lines(make_lines(2000, ['box', 'cone', 'pipe']))
+        grid = instances_utils.LocationGrid(table, tolerance)
+        taken = np.zeros(len(table), dtype=np.bool_)
+        rng = np.random.RandomState(1)
+        for _ in range(3000):
+            name = ['box', 'cone', 'pipe', 'unknown'][rng.randint(4)]
+            location = rng.randint(0, 5, 3) * 0.5 + rng.uniform(-0.4, 0.4, 3)
+            scale = rng.choice([1, -1], 3)
+            rotation = rng.randint(0, 3) * 0.25
+            mesh = table.get_mesh_index(name)
+            expected = None
+            if mesh is not None:
+                # The first record, that is not taken and is equal with tolerance
+                mask = ((table.records['mesh'] == mesh) & ~taken &
+                        table.match(np.arange(len(table)), location, scale, rotation, tolerance))
+                if mask.any():
+                    expected = int(np.flatnonzero(mask)[0])
+                    taken[expected] = True
+            self.assertEqual(grid.take(name, location, scale, rotation), expected)
+
+
+class BinaryFileTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.directory, 'instances' + instances_utils.BINARY_EXT)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        table = InstanceTable.from_lines(make_lines(1000, ['box', 'cone', 'труба']))
+        with open(self.filepath, 'wb') as f:
+            table.write_binary(f)
+        self.assertTrue(instances_utils.is_binary_file(self.filepath))
+        tables = list(instances_utils.iter_tables(self.filepath, chunk_size=100))
+        self.assertTrue(all(len(t) <= 100 for t in tables))
+        # Records are grouped by mesh in file order
+        expected = sorted(get_records(table), key=lambda record: table.get_mesh_index(record[0]))
+        self.assertEqual(get_records(InstanceTable.concatenate(tables)), expected)
+
+    def test_names(self):
+        table = InstanceTable.from_lines(make_lines(100, ['box', 'cone']))
+        with open(self.filepath, 'wb') as f:
+            table.write_binary(f)
+        records = get_records(InstanceTable.concatenate(
+            instances_utils.iter_binary_tables(self.filepath, names={'cone'})))
+        self.assertEqual(records, [r for r in get_records(table) if r[0] == 'cone'])
+
+
+class ParseRangeTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.directory, 'instances.txt')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def check_ranges(self, encoding, names=None):
+        lines = make_lines(3000, ['box', 'cone', 'труба'])
+        with open(self.filepath, 'w', encoding=encoding) as f:
+            f.writelines(lines)
+        ranges = instances_utils.get_byte_ranges(self.filepath, range_size=4096)
+        self.assertGreater(len(ranges), 1)
+        self.assertEqual(ranges[0][0], 0)
+        self.assertEqual(ranges[-1][1], os.path.getsize(self.filepath))
+        tables = [InstanceTable(*instances_utils.parse_range((self.filepath, start, end, names, encoding)))
+                  for start, end in ranges]
+        self.assertEqual(get_records(InstanceTable.concatenate(tables)),
+                         get_records(InstanceTable.from_lines(lines, names)))
+
+    def test_ranges_as_sequential(self):
+        self.check_ranges('utf-8')
+
+    def test_ranges_with_names(self):
+        self.check_ranges('utf-8', names={'труба'})
+
+    def test_ranges_in_locale_encoding(self):
+        self.check_ranges('cp1251')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+"""
+Tests of stored vertex selections. They need Blender, run them with
+blender -b --python tests/test_selectors.py
+"""
+import os
+import sys
+import unittest
+
+try:
+    import bmesh
+    import bpy
+except ImportError:
+    raise unittest.SkipTest('Needs Blender: blender -b --python tests/test_selectors.py')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Bargool_1D_tools
+
+__author__ = 'Aleksey Nakoryakov'
+
+
+def setUpModule():
+    Bargool_1D_tools.register()
+
+
+def tearDownModule():
+    Bargool_1D_tools.unregister()
+
+
+def add_edit_object(name, co):
+    """ Links object with loose vertices co to scene and enters edit mode """
+    mesh = bpy.data.meshes.new(name)
+    mesh.from_pydata(co, [], [])
+    obj = bpy.data.objects.new(name, mesh)
+    scene = bpy.context.scene
+    scene.objects.link(obj)
+    scene.objects.active = obj
+    bpy.ops.object.mode_set(mode='EDIT')
+    return obj
+
+
+class RestoreVertexSelectionTest(unittest.TestCase):
+    def setUp(self):
+        self.obj = add_edit_object('selection', [(0, 0, 0), (1, 0, 0), (0, 1, 0)])
+        bpy.context.scene.batch_operator_settings.vertex_selection_name = 'stored'
+
+    def tearDown(self):
+        bpy.ops.object.mode_set(mode='OBJECT')
+        bpy.context.scene.objects.unlink(self.obj)
+        bpy.data.objects.remove(self.obj)
+
+    def set_selection(self, select):
+        for v, s in zip(bmesh.from_edit_mesh(self.obj.data).verts, select):
+            v.select = s
+
+    def get_selection(self):
+        return [v.select for v in bmesh.from_edit_mesh(self.obj.data).verts]
+
+    def add_vertex(self):
+        """ Adds vertex in edit mode, so mesh.vertices stay stale """
+        bmesh.from_edit_mesh(self.obj.data).verts.new((2.0, 2.0, 0.0))
+        bmesh.update_edit_mesh(self.obj.data)
+
+    def test_skips_stored_before_adding_vertices(self):
+        self.set_selection([True, False, False])
+        bpy.ops.mesh.store_vertex_selection()
+        self.add_vertex()
+        self.set_selection([False] * 4)
+        bpy.ops.mesh.restore_vertex_selection(operator_type='DO_UNION')
+        self.assertEqual(self.get_selection(), [False] * 4)
+
+    def test_restores_stored_after_adding_vertices(self):
+        self.add_vertex()
+        self.set_selection([False, True, False, True])
+        bpy.ops.mesh.store_vertex_selection()
+        self.set_selection([True, False, False, False])
+        bpy.ops.mesh.restore_vertex_selection(operator_type='DO_UNION')
+        self.assertEqual(self.get_selection(), [True, True, False, True])
+
+
+if __name__ == '__main__':
+    unittest.main(argv=[__file__])